@@ -0,0 +1,204 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import cv2
+from image_delaunay_morphing import morph_iter
+
+
+def read_manifest(path):
+    """
+    Reads a JSON manifest, a list of pairs like
+    {"image1": "1890.jpg", "image2": "today.jpg", "points1": [[x, y], ...],
+     "points2": [[x, y], ...], "alpha": 0.5, "steps": 10, "output": "out/pair"}
+    Relative paths are resolved against the directory of the manifest. Pairs are
+    not checked here, see validate_pair.
+    """
+    with open(path) as f:
+        pairs = json.load(f)
+    assert isinstance(pairs, list), "Manifest has to be a JSON list of pairs"
+    base = os.path.dirname(os.path.abspath(path))
+    for pair in pairs:
+        for key in ("image1", "image2", "output"):
+            if isinstance(pair, dict) and isinstance(pair.get(key), str):
+                pair[key] = os.path.join(base, pair[key])
+    return pairs
+
+
+def validate_pair(pair, paths=("image1", "image2", "output")):
+    """
+    Raises ValueError unless pair has the shape of a manifest pair: the given
+    paths, equally long non empty lists of [x, y] pairs of numbers, alpha
+    between 0 and 1 and at least 2 steps if given.
+    """
+    if not isinstance(pair, dict):
+        raise ValueError("Pair has to be a JSON object")
+    for name in paths:
+        if not isinstance(pair.get(name), str):
+            raise ValueError("%s has to be a path" % (name,))
+    for name in ("points1", "points2"):
+        points = pair.get(name)
+        if not isinstance(points, list) or not points:
+            raise ValueError("%s has to be a non empty list of points" % (name,))
+        for point in points:
+            if (not isinstance(point, list) or len(point) != 2 or
+                    not all(is_number(value) for value in point)):
+                raise ValueError("%s has to hold [x, y] pairs of numbers, got %r" % (name, point))
+    if len(pair["points1"]) != len(pair["points2"]):
+        raise ValueError("points1 and points2 have different size")
+    alpha = pair.get("alpha", 0.5)
+    if not is_number(alpha) or not 0 <= alpha <= 1:
+        raise ValueError("alpha has to be a number between 0 and 1")
+    steps = pair.get("steps", 2)
+    if not isinstance(steps, int) or isinstance(steps, bool) or steps < 2:
+        raise ValueError("steps has to be an integer of at least 2")
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def init_worker(cv_threads):
+    """
+    Limits OpenCV's own thread pool inside a worker process.
+    """
+    cv2.setNumThreads(cv_threads)
+
+
+def morph_pair(pair):
+    """
+    Morphs one manifest pair and writes the frames as numbered PNG files to its
+    output directory. Returns a result dict, failures are reported in it instead
+    of raised.
+    """
+    result = new_result(pair)
+    start = time.time()
+    try:
+        img1 = cv2.imread(pair["image1"])
+        img2 = cv2.imread(pair["image2"])
+        assert img1 is not None, "Image 1 not readable or not found"
+        assert img2 is not None, "Image 2 not readable or not found"
+        points1 = [tuple(point) for point in pair["points1"]]
+        points2 = [tuple(point) for point in pair["points2"]]
+
+        if not os.path.isdir(pair["output"]):
+            os.makedirs(pair["output"])
+        frames = morph_iter(img1, img2, points1, points2, pair.get("alpha", 0.5), pair.get("steps", 2))
+        for i, frame in enumerate(frames):
+            path = os.path.join(pair["output"], "%04d.png" % i)
+            assert cv2.imwrite(path, frame), "Could not write %s" % path
+            result["frames"] += 1
+    except Exception:
+        result["error"] = traceback.format_exc()
+    result["seconds"] = time.time() - start
+    return result
+
+
+def new_result(pair, error=None):
+    """
+    Returns the result dict of morph_pair for pair, with error if given.
+    """
+    get = pair.get if isinstance(pair, dict) else lambda key: None
+    return {"image1": get("image1"), "image2": get("image2"), "output": get("output"),
+            "frames": 0, "seconds": 0.0, "error": error}
+
+
+def morph_alone(pair, cv_threads):
+    """
+    Morphs pair in a process of its own, so a crash can be told apart from the
+    crashes of other pairs. Returns its result dict.
+    """
+    with ProcessPoolExecutor(max_workers=1, initializer=init_worker, initargs=(cv_threads,)) as executor:
+        try:
+            return executor.submit(morph_pair, pair).result()
+        except BrokenProcessPool as error:
+            return new_result(pair, "Worker process died: %s" % (error,))
+
+
+def morph_batch(pairs, workers=None, cv_threads=None, max_breaks=2):
+    """
+    Morphs all pairs on a pool of worker processes, yields result dicts in
+    manifest order. Malformed pairs (see validate_pair) fail without running.
+    A worker process dying, e.g. killed for running out of memory, breaks the
+    pool and every pair pending in it. They are resubmitted to a new pool, a
+    pair that was pending in max_breaks broken pools is run alone by
+    morph_alone and fails if its process dies too.
+    Unless given, OpenCV gets cpu_count / workers threads per worker so the
+    machine isn't oversubscribed.
+    """
+    cpus = multiprocessing.cpu_count()
+    if workers is None:
+        workers = cpus
+    if cv_threads is None:
+        cv_threads = max(1, cpus // workers)
+
+    def new_pool():
+        return ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(cv_threads,))
+
+    executor = new_pool()
+    # Per pair a future, an error message or None once it is left to morph_alone
+    futures = {}
+    breaks = [0] * len(pairs)
+    try:
+        for i, pair in enumerate(pairs):
+            try:
+                validate_pair(pair)
+            except ValueError as error:
+                futures[i] = "ValueError: %s" % (error,)
+            else:
+                futures[i] = executor.submit(morph_pair, pair)
+
+        for i, pair in enumerate(pairs):
+            while True:
+                future = futures[i]
+                if isinstance(future, str):
+                    yield new_result(pair, future)
+                    break
+                if future is None:
+                    yield morph_alone(pair, cv_threads)
+                    break
+                try:
+                    result = future.result()
+                except BrokenProcessPool:
+                    executor.shutdown(wait=False)
+                    executor = new_pool()
+                    for j in range(i, len(pairs)):
+                        if isinstance(futures[j], str) or futures[j] is None:
+                            continue
+                        if futures[j].done() and futures[j].exception() is None:
+                            continue
+                        breaks[j] += 1
+                        futures[j] = executor.submit(morph_pair, pairs[j]) if breaks[j] < max_breaks else None
+                else:
+                    yield result
+                    break
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Morph all image pairs of a manifest.")
+    parser.add_argument("manifest", help="JSON list of pairs, see read_manifest")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="worker processes, default one per CPU")
+    parser.add_argument("-t", "--cv-threads", type=int, default=None, help="OpenCV threads per worker")
+    args = parser.parse_args(argv)
+
+    failures = 0
+    start = time.time()
+    for result in morph_batch(read_manifest(args.manifest), args.workers, args.cv_threads):
+        if result["error"] is None:
+            print("ok     %7.2fs %4d frames  %s" % (result["seconds"], result["frames"], result["output"]))
+        else:
+            failures += 1
+            print("FAILED %7.2fs %s\n%s" % (result["seconds"], result["output"], result["error"]))
+    print("%d failed, %.2fs total" % (failures, time.time() - start))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,31 @@
+import sys
+import timeit
+import numpy as np
+from image_delaunay_morphing import get_indices
+
+
+def random_points(count, width, height, seed=0):
+    """
+    Returns count distinct random integer points inside an image of given size.
+    """
+    rng = np.random.RandomState(seed)
+    keys = rng.choice(width * height, count, replace=False)
+    return [(int(key % width), int(key // width)) for key in keys]
+
+
+def benchmark(counts=(10, 100, 1000, 10000), width=6000, height=4000, repeat=3):
+    """
+    Times get_indices for growing numbers of points, prints one line per count.
+    """
+    rect = (0, 0, width, height)
+    print("%8s %10s %12s" % ("points", "triangles", "seconds"))
+    for count in counts:
+        points = random_points(count, width, height)
+        indices_tri = get_indices(rect, points)
+        seconds = min(timeit.repeat(lambda: get_indices(rect, points), number=1, repeat=repeat))
+        print("%8d %10d %12.6f" % (count, len(indices_tri), seconds))
+
+
+if __name__ == "__main__":
+    counts = [int(arg) for arg in sys.argv[1:]] or (10, 100, 1000, 10000)
+    benchmark(counts)
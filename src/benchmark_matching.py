@@ -0,0 +1,62 @@
+import sys
+import time
+import numpy as np
+import cv2
+from benchmark_morph import synthetic_pair
+from point_matching import FeatureCache
+from point_matching import available_methods
+from point_matching import find_points_many
+
+
+def warped_set(width, height, count, seed=0):
+    """
+    Returns a textured image and count random perspective warps of it with the
+    homographies used.
+    """
+    rng = np.random.RandomState(seed)
+    img = synthetic_pair(width // 4, height // 4, 0, seed)[0]
+    img = cv2.resize(img, (width, height), interpolation=cv2.INTER_NEAREST)
+    img = np.uint8(np.clip(np.int16(img) + rng.randint(-40, 41, img.shape), 0, 255))
+    corners = np.float32([[0, 0], [width, 0], [width, height], [0, height]])
+    images, homographies = [], []
+    for i in range(0, count):
+        moved = corners + np.float32(rng.uniform(-0.08, 0.08, (4, 2)) * (width, height))
+        homography = cv2.getPerspectiveTransform(corners, moved)
+        images.append(cv2.warpPerspective(img, homography, (width, height)))
+        homographies.append(homography)
+    return img, images, homographies
+
+
+def benchmark(width=1600, height=1200, count=20, methods=None):
+    """
+    Matches one image against count warped copies, prints pairs per second,
+    matched points and the median error against the true homography.
+    """
+    if methods is None:
+        methods = available_methods()
+    img, images, homographies = warped_set(width, height, count)
+    print("%8s %12s %10s %10s" % ("method", "pairs/s", "points", "error px"))
+    for method in methods:
+        cache = FeatureCache(method, max_images=count + 1)
+        start = time.time()
+        results = list(find_points_many(img, images, cache))
+        seconds = time.time() - start
+        points, errors = 0, []
+        for (points1, points2), homography in zip(results, homographies):
+            if not points1:
+                continue
+            expected = cv2.perspectiveTransform(np.float32(points1).reshape(-1, 1, 2), homography).reshape(-1, 2)
+            errors.append(np.linalg.norm(expected - np.float32(points2), axis=1))
+            points += len(points1)
+        error = np.median(np.concatenate(errors)) if errors else float("nan")
+        print("%8s %12.2f %10d %10.2f" % (method, count / seconds, points // count, error))
+
+        # Matching again only costs hashing and matching, features are cached
+        start = time.time()
+        list(find_points_many(img, images, cache))
+        print("%8s %12.2f %10s %10s" % ("cached", count / (time.time() - start), "", ""))
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    benchmark(count=count)
@@ -0,0 +1,107 @@
+import sys
+import time
+import tracemalloc
+import numpy as np
+import cv2
+from image_delaunay_morphing import morph
+from image_delaunay_morphing import prepare_points
+from image_helpers import scale_image
+from verify_crop_indices import reference_crop_indices
+
+
+def synthetic_pair(width, height, count, seed=0):
+    """
+    Returns two smooth random images of given size and count corresponding points.
+    """
+    rng = np.random.RandomState(seed)
+    small = (max(1, width // 16), max(1, height // 16))
+    img1 = cv2.resize(np.uint8(rng.randint(0, 256, small[::-1] + (3, ))), (width, height), interpolation=cv2.INTER_CUBIC)
+    img2 = cv2.resize(np.uint8(rng.randint(0, 256, small[::-1] + (3, ))), (width, height), interpolation=cv2.INTER_CUBIC)
+    points_img1 = [(int(x), int(y)) for x, y in zip(rng.randint(width // 10, width - width // 10, count),
+                                                     rng.randint(height // 10, height - height // 10, count))]
+    points_img2 = [(x + int(rng.randint(-width // 50, width // 50 + 1)), y + int(rng.randint(-height // 50, height // 50 + 1)))
+                   for x, y in points_img1]
+    return img1, img2, points_img1, points_img2
+
+
+def measure(fn):
+    """
+    Returns seconds and peak traced memory in MB of calling fn. Tracing slows
+    Python code down, so fn is timed in a separate untraced call.
+    """
+    start = time.time()
+    fn()
+    seconds = time.time() - start
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak / 2.0 ** 20
+
+
+def baseline_morph(img1, img2, points_img1, points_img2, alpha=0.5, steps=2):
+    """
+    The morph before the plan, coverage mask and in place blending changes,
+    kept as reference for benchmark: float32 images offset by a small number
+    to find the padding, per triangle affine transforms and antialiased float
+    masks rebuilt for every frame, read modify write blending, all frames kept
+    until the pixel by pixel crop search. Points are prepared by prepare_points
+    as in morph.
+    """
+    points_img1, points_img2, points, indices_tri, factor1, factor2, shape = prepare_points(
+        img1.shape, img2.shape, points_img1, points_img2, alpha)
+    img1 = scale_image(np.float32(img1) + 0.00000001, factor1, shape)
+    img2 = scale_image(np.float32(img2) + 0.00000001, factor2, shape)
+
+    images = []
+    for a in np.linspace(0.0, 1.0, num=steps):
+        img_morph = np.zeros(shape, dtype=np.float32)
+        for t1, t2, t in zip(points_img1[indices_tri], points_img2[indices_tri], points[indices_tri]):
+            r1 = cv2.boundingRect(t1)
+            r2 = cv2.boundingRect(t2)
+            r = cv2.boundingRect(t)
+            t1_rect = t1 - np.float32(r1[0:2])
+            t2_rect = t2 - np.float32(r2[0:2])
+            t_rect = t - np.float32(r[0:2])
+
+            mask = np.zeros((r[3], r[2], 3), dtype=np.float32)
+            cv2.fillConvexPoly(mask, np.int32(t_rect), (1.0, 1.0, 1.0), 16, 0)
+
+            size = (r[2], r[3])
+            warp_image1 = cv2.warpAffine(img1[r1[1]:r1[1] + r1[3], r1[0]:r1[0] + r1[2]],
+                                         cv2.getAffineTransform(t1_rect, t_rect), size, None,
+                                         flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REFLECT_101)
+            warp_image2 = cv2.warpAffine(img2[r2[1]:r2[1] + r2[3], r2[0]:r2[0] + r2[2]],
+                                         cv2.getAffineTransform(t2_rect, t_rect), size, None,
+                                         flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REFLECT_101)
+            img_rect = (1.0 - a) * warp_image1 + a * warp_image2
+            img_morph[r[1]:r[1] + r[3], r[0]:r[0] + r[2]] = \
+                img_morph[r[1]:r[1] + r[3], r[0]:r[0] + r[2]] * (1 - mask) + img_rect * mask
+        images.append(np.copy(img_morph))
+
+    x_min_1, x_max_1, y_min_1, y_max_1 = reference_crop_indices(images[0])
+    x_min_2, x_max_2, y_min_2, y_max_2 = reference_crop_indices(images[-1])
+    x_min, x_max, y_min, y_max = max(x_min_1, x_min_2), min(x_max_1, x_max_2), max(y_min_1, y_min_2), min(y_max_1, y_max_2)
+    return [np.uint8(image[y_min:y_max, x_min:x_max] - 0.00000001) for image in images]
+
+
+def benchmark(sizes=((640, 480), (1920, 1080), (4000, 3000)), steps=10, count=50):
+    """
+    Times baseline_morph and morph in float32 and uint8 precision, prints
+    seconds and peak memory.
+    """
+    print("%12s %8s %10s %10s" % ("size", "version", "seconds", "peak MB"))
+    for width, height in sizes:
+        img1, img2, points_img1, points_img2 = synthetic_pair(width, height, count)
+        runs = [("baseline", lambda: baseline_morph(img1, img2, list(points_img1), list(points_img2), 0.5, steps))]
+        for dtype in (np.float32, np.uint8):
+            runs.append((np.dtype(dtype).name, lambda dtype=dtype: morph(img1, img2, list(points_img1),
+                                                                         list(points_img2), 0.5, steps, dtype=dtype)))
+        for name, fn in runs:
+            seconds, peak = measure(fn)
+            print("%12s %8s %10.3f %10.1f" % ("%dx%d" % (width, height), name, seconds, peak))
+
+
+if __name__ == "__main__":
+    steps = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    benchmark(steps=steps)
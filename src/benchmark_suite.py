@@ -0,0 +1,137 @@
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+import numpy as np
+import cv2
+import sac
+from benchmark_indices import random_points
+from benchmark_morph import synthetic_pair
+from image_delaunay_morphing import get_indices
+from image_delaunay_morphing import morph
+from image_helpers import get_crop_indices
+from image_helpers import scale
+
+SIZES = ((640, 480), (1920, 1080))
+LARGE_SIZES = ((4000, 3000), )
+POINT_COUNTS = (50, 500)
+
+
+def run_case(fn, megapixels, repeat=3):
+    """
+    Returns best seconds of repeat calls of fn, throughput in megapixels per
+    second and peak traced memory in MB of one more, traced call.
+    """
+    seconds = float("inf")
+    for i in range(0, repeat):
+        start = time.perf_counter()
+        fn()
+        seconds = min(seconds, time.perf_counter() - start)
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"seconds": seconds, "mp_per_s": megapixels / seconds, "peak_mb": peak / 2.0 ** 20}
+
+
+def black_border(img, seed=0):
+    """
+    Returns img rotated slightly, so it has black corners like morphed frames.
+    """
+    rng = np.random.RandomState(seed)
+    height, width = img.shape[0:2]
+    warp_mat = cv2.getRotationMatrix2D((width / 2.0, height / 2.0), rng.uniform(2, 6), 1.0)
+    return cv2.warpAffine(img, warp_mat, (width, height))
+
+
+def cases(sizes, point_counts, steps):
+    """
+    Yields name, function and processed megapixels of every benchmark case.
+    Inputs are synthetic and seeded, so all runs measure the same work.
+    """
+    for width, height in sizes:
+        megapixels = width * height / 1e6
+        size = "%dx%d" % (width, height)
+        for count in point_counts:
+            img1, img2, points_img1, points_img2 = synthetic_pair(width, height, count)
+            yield ("morph/%s/%d" % (size, count),
+                   lambda: morph(img1, img2, list(points_img1), list(points_img2), 0.5, steps), megapixels * steps)
+            points = random_points(count, width, height)
+            yield ("get_indices/%s/%d" % (size, count),
+                   lambda: get_indices((0, 0, width, height), points), megapixels)
+
+        img1, img2, points_img1, points_img2 = synthetic_pair(width, height, 50)
+        small = cv2.resize(img2, (width * 3 // 4, height * 2 // 3))
+        small_points = [(x * 3 // 4, y * 2 // 3) for x, y in points_img2]
+        yield "scale/%s" % size, lambda: scale(img1, small, list(points_img1), list(small_points)), megapixels
+
+        bordered = black_border(img1)
+        yield "get_crop_indices/%s" % size, lambda: get_crop_indices(bordered), megapixels
+
+        # Rectangle of half the image around its centre
+        point1 = (width // 4, height // 4)
+        point2 = (width * 3 // 4, height * 3 // 4)
+        yield ("getPointFromRectangle/%s" % size, lambda: sac.getPointFromRectangle(img1, point1, point2),
+               megapixels / 4)
+        yield ("getPointFromRectangle_pyramid/%s" % size,
+               lambda: sac.getPointFromRectangle(img1, point1, point2, pyramid=True), megapixels / 4)
+
+
+def compare(results, baseline, tolerance, slack=0.002):
+    """
+    Returns messages for all cases which are more than tolerance times and more
+    than slack seconds slower than in baseline. The slack keeps sub-millisecond
+    cases from failing on timer noise.
+    """
+    failures = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["seconds"] / baseline[name]["seconds"]
+        if ratio > tolerance and result["seconds"] - baseline[name]["seconds"] > slack:
+            failures.append("%s is %.2fx slower than baseline (%.4fs vs %.4fs)" % (
+                name, ratio, result["seconds"], baseline[name]["seconds"]))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless benchmarks of morph and its helpers.")
+    parser.add_argument("-b", "--baseline", help="baseline JSON to compare against")
+    parser.add_argument("-s", "--save", help="write results as JSON, e.g. as new baseline")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="allowed slowdown factor, default 1.5")
+    parser.add_argument("--large", action="store_true", help="also benchmark 4000x3000 images")
+    parser.add_argument("--steps", type=int, default=3, help="morph steps")
+    parser.add_argument("--repeat", type=int, default=3, help="timed calls per case, best is kept")
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    sizes = SIZES + LARGE_SIZES if args.large else SIZES
+    results = {}
+    print("%-42s %10s %10s %10s %8s" % ("case", "seconds", "MP/s", "peak MB", "vs base"))
+    for name, fn, megapixels in cases(sizes, POINT_COUNTS, args.steps):
+        result = run_case(fn, megapixels, args.repeat)
+        results[name] = result
+        ratio = "%.2fx" % (result["seconds"] / baseline[name]["seconds"]) if name in baseline else ""
+        print("%-42s %10.4f %10.2f %10.1f %8s" % (name, result["seconds"], result["mp_per_s"], result["peak_mb"],
+                                                 ratio))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    failures = compare(results, baseline, args.tolerance)
+    if failures:
+        print("\nREGRESSION: %d cases slower than %.2fx baseline" % (len(failures), args.tolerance))
+        for failure in failures:
+            print("  " + failure)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,22 +1,53 @@
+import hashlib
 import numpy as np
 import cv2
 
 
-def get_crop_indices(img):
+def get_crop_indices(img, exact=False):
     """
     Get crop indices to crop black border from image.
     Crops non linear borders.
     Starts with small rectangle in middle, grows till black pixels are reached
     at each site.
-    """        
-    
-    x_min= int(img.shape[1] / 2) - 1
-    y_min= int(img.shape[0] / 2) - 1
-    x_max= int(img.shape[1] / 2) + 1
-    y_max= int(img.shape[0] / 2) + 1
-    
-    x_step_size = int((img.shape[1]/100) * 2)
-    y_step_size = int((img.shape[0]/100) * 2) 
+    Black pixels are counted with a summed area table, so checking a site is
+    constant time. By default the rectangle grows in steps of 2% of the image
+    size, exact=True grows it pixel by pixel.
+    """
+    # 1 where all channels are zero
+    black = cv2.inRange(img, 0, 0)
+    np.bitwise_and(black, 1, out=black)
+    # black_sum[y, x] is the number of black pixels in black[:y, :x]
+    black_sum = cv2.integral(black)
+
+    def has_black(y_start, y_end, x_start, x_end):
+        return black_sum[y_end, x_end] - black_sum[y_start, x_end] - black_sum[y_end, x_start] + black_sum[y_start, x_start] > 0
+
+    return grow_crop_window(has_black, black.shape[0], black.shape[1], exact)
+
+
+def grow_crop_window(has_black, height, width, exact=False):
+    """
+    Grows the crop window of get_crop_indices for an image of given size.
+    has_black(y_start, y_end, x_start, x_end) tells whether the image region
+    contains black pixels.
+    """
+    x_min = int(width / 2) - 1
+    y_min = int(height / 2) - 1
+    x_max = int(width / 2) + 1
+    y_max = int(height / 2) + 1
+
+    if exact:
+        x_step_size = 1
+        y_step_size = 1
+        # Check the line that becomes part of the rectangle, along the whole site
+        offset = 0
+        trim = 0
+    else:
+        x_step_size = max(1, int((width / 100) * 2))
+        y_step_size = max(1, int((height / 100) * 2))
+        # Check the line one step outside, the last pixel of a site is not checked
+        offset = 1
+        trim = 1
 
     top_done = False
     left_done = False
@@ -24,54 +55,38 @@ def get_crop_indices(img):
     right_done = False
 
     while not top_done or not right_done or not bottom_done or not left_done:
-        # check left  
-        if not left_done and x_min - x_step_size > -1: 
-            for y in range(y_min, y_max):
-                value = img[y, x_min - x_step_size, :]
-                if sum(value) == 0:
-                    left_done = True   
-                    break
-            if y == y_max -1 :
-                left_done = False
+        # check left
+        x = x_min - x_step_size
+        if not left_done and x > -1:
+            left_done = has_black(y_min, y_max - trim, x, x + 1)
+            if not left_done:
                 x_min -= x_step_size
         else:
             left_done = True
 
         # check bottom
-        if not bottom_done and y_max + y_step_size < img.shape[0] :
-            for x in range(x_min, x_max):
-                value = img[y_max + y_step_size, x, :]
-                if sum(value) ==  0:
-                    bottom_done = True 
-                    break
-            if x == x_max - 1:
-                bottom_done = False 
+        y = y_max + offset * y_step_size
+        if not bottom_done and y < height:
+            bottom_done = has_black(y, y + 1, x_min, x_max - trim)
+            if not bottom_done:
                 y_max += y_step_size
         else:
             bottom_done = True
 
         # check right
-        if not right_done and x_max + x_step_size < img.shape[1] :
-            for y in range(y_min, y_max):
-                value = img[y, x_max + x_step_size, :]
-                if sum(value) == 0:
-                    right_done = True
-                    break
-            if y == y_max - 1:
-                right_done = False
+        x = x_max + offset * x_step_size
+        if not right_done and x < width:
+            right_done = has_black(y_min, y_max - trim, x, x + 1)
+            if not right_done:
                 x_max += x_step_size
         else:
             right_done = True
 
-        # check top  
-        if not top_done and y_min - y_step_size > -1:
-            for x in range(x_min, x_max):
-                value = img[y_min - y_step_size, x , :]
-                if sum(value) == 0:
-                    top_done = True
-                    break
-            if x == x_max - 1:
-                top_done = False
+        # check top
+        y = y_min - y_step_size
+        if not top_done and y > -1:
+            top_done = has_black(y, y + 1, x_min, x_max - trim)
+            if not top_done:
                 y_min -= y_step_size
         else:
             top_done = True
@@ -79,6 +94,22 @@ def get_crop_indices(img):
     return x_min, x_max, y_min, y_max
 
 
+def as_points(points):
+    """
+    Returns points, a list of (x, y) pairs or an array, as (N, 2) float32 array.
+    Arrays of that type are returned as they are, without copy.
+    """
+    return np.asarray(points, dtype=np.float32).reshape(-1, 2)
+
+
+def points_inside(points, shape):
+    """
+    Returns a bool array telling which of the (N, 2) points lie inside an image of shape.
+    """
+    points = as_points(points)
+    return (points[:, 0] >= 0) & (points[:, 0] < shape[1]) & (points[:, 1] >= 0) & (points[:, 1] < shape[0])
+
+
 def weighted_average_point(point1, point2, alpha):
     """
     Return the average point between two points weighted by alpha.
@@ -88,33 +119,39 @@ def weighted_average_point(point1, point2, alpha):
     return (x,y)
 
 
-def compute_corner(corner_x, corner_y, f, corners_img1, corners_img2, pointpairs, x_max, y_max, x_mean, y_mean):
+def weighted_average_points(points_img1, points_img2, alpha):
     """
-    Computes the position of a corner, given former corner position and sorting function.
+    Returns weighted_average_point of all pairs of points as (N, 2) float32 array.
+    Averages are truncated to integers like there.
     """
-    pointpair = min(pointpairs, key=f)
-
-    delta_x_half = int((pointpair[0][0] - pointpair[1][0])/2)
-    delta_y_half = int((pointpair[0][1] - pointpair[1][1])/2)
+    points = (1 - alpha) * np.float64(as_points(points_img1)) + alpha * np.float64(as_points(points_img2))
+    return np.float32(np.trunc(points))
 
-    if corner_x == 0:
-        x_1 = 0 + abs(delta_x_half) + delta_x_half
-        x_2 = 0 + abs(delta_x_half) - delta_x_half
-    elif corner_x == x_max:
-        x_1 = x_max - abs(delta_x_half) + delta_x_half
-        x_2 = x_max - abs(delta_x_half) - delta_x_half
 
-    if corner_y == 0:
-        y_1 = 0 + abs(delta_y_half) + delta_y_half
-        y_2 = 0 + abs(delta_y_half) - delta_y_half
-    elif corner_y == y_max:
-        y_1 = y_max - abs(delta_y_half) + delta_y_half
-        y_2 = y_max - abs(delta_y_half) - delta_y_half
+def corner_points(shape1, shape2, points_img1, points_img2):
+    """
+    Computes the corner points add_corners adds for images of shape1 and shape2.
+    For every corner the point pair whose point in image 1 is nearest to it
+    (in sum of x and y distance) is taken, both corners are offset by half the
+    delta between its points.
+    Returns the corners of image 1 and image 2 as (4, 2) float32 arrays in the
+    order bottom left, bottom right, top right, top left.
+    """
+    x_max = min(shape1[1], shape2[1]) - 1
+    y_max = min(shape1[0], shape2[0]) - 1
+    corners = np.float64([(0, y_max), (x_max, y_max), (x_max, 0), (0, 0)])
+    # Direction pointing from every corner into the image
+    inward = np.float64([(1, -1), (-1, -1), (-1, 1), (1, 1)])
 
-    corners_img1.append((x_1, y_1))
-    corners_img2.append((x_2, y_2))
+    points_img1 = np.float64(as_points(points_img1))
+    points_img2 = np.float64(as_points(points_img2))
+    # distance[i, c] is the distance of point i to corner c, the first minimum is taken
+    distance = np.matmul(points_img1, inward.T) - (corners * inward).sum(axis=1)
+    nearest = np.argmin(distance, axis=0)
 
-    return
+    delta_half = np.trunc((points_img1[nearest] - points_img2[nearest]) / 2)
+    corners = corners + np.abs(delta_half) * inward
+    return np.float32(corners + delta_half), np.float32(corners - delta_half)
 
 
 def get_corners(img, img2, points_img1, points_img2):
@@ -123,100 +160,211 @@ def get_corners(img, img2, points_img1, points_img2):
     four middle points of the edges of the image. Computes the delta between
     them and their coresponding points. Adds corner points and middle points of
     edges to the point lists and offsets them using the computet delta values.
-    Returns the global max and minima used for cropping
+    Returns the extended points, see add_corners.
+    """
+    return add_corners(img.shape, img2.shape, points_img1, points_img2)
+
+
+def add_corners(shape1, shape2, points_img1, points_img2):
     """
+    Adds the corner points of get_corners for images of shape1 and shape2 and
+    returns the extended points. Lists are extended in place with integer
+    pairs, arrays are returned as new (N + 4, 2) float32 arrays.
+    """
+    corners_img1, corners_img2 = corner_points(shape1, shape2, points_img1, points_img2)
+    extended = []
+    for points, corners in ((points_img1, corners_img1), (points_img2, corners_img2)):
+        if isinstance(points, list):
+            points += [(int(x), int(y)) for x, y in corners.tolist()]
+        else:
+            points = np.concatenate((as_points(points), corners))
+        extended.append(points)
+    return extended[0], extended[1]
 
-    x_max = min(img.shape[1], img2.shape[1]) - 1
-    y_max = min(img.shape[0], img2.shape[0]) - 1
-    x_mean = int(x_max / 2)
-    y_mean = int(y_max / 2)
-    corners_img1 = []
-    corners_img2 = []
-    pointpairs = zip(points_img1[:], points_img2[:])
 
-    # bottom left 
-    compute_corner(0, y_max, lambda p: ((p[0])[0] + (y_max - (p[0])[1])), corners_img1, corners_img2, pointpairs, x_max, y_max, x_mean, y_mean)
+def scale(img1, img2, points_img1, points_img2, max_size=None, max_megapixels=None):
+    """
+    Prescales images and points to allow delaunay morphing of images of different sizes.
+    Upsacles the smaller image, then downscales both to max_size or
+    max_megapixels if given, see scale_points.
+    Points are lists of (x, y) pairs or arrays, scaled points are returned as
+    (N, 2) float32 arrays.
+    """
+    points_img1, points_img2, factor1, factor2, shape = scale_points(img1.shape, img2.shape, points_img1, points_img2,
+                                                                     max_size, max_megapixels)
+    return scale_image(img1, factor1, shape), scale_image(img2, factor2, shape), points_img1, points_img2
 
-    # bottom right
-    compute_corner(x_max, y_max, lambda p: ((x_max - (p[0])[0]) + (y_max - (p[0])[1])), corners_img1, corners_img2, pointpairs, x_max, y_max, x_mean, y_mean)
 
-    # top right
-    compute_corner(x_max, 0, lambda p: ((x_max - (p[0])[0]) + (p[0])[1]), corners_img1, corners_img2, pointpairs, x_max, y_max, x_mean, y_mean)
+def scale_image(img, factor, shape):
+    """
+    Resizes img by factor and pads it with zeros to shape, see scale_points.
+    """
+    if factor > 1.0:
+        img = cv2.resize(img, (0,0), fx=factor, fy=factor, interpolation=cv2.INTER_LINEAR)
+    elif factor < 1.0:
+        img = cv2.resize(img, (0,0), fx=factor, fy=factor, interpolation=cv2.INTER_AREA)
+    if img.shape != tuple(shape):
+        temp_img = np.zeros(shape, dtype=img.dtype)
+        temp_img[0:img.shape[0], 0:img.shape[1], 0:img.shape[2]] = img
+        img = temp_img
+    return img
+
+
+def scaled_size(shape, factor):
+    """
+    Returns height and width of an image of shape after scale_image resized it by factor.
+    """
+    if factor == 1.0:
+        return shape[0], shape[1]
+    return int(round(shape[0] * factor)), int(round(shape[1] * factor))
 
-    # top left
-    compute_corner(0, 0, lambda p: ((p[0])[0] + (p[0])[1]), corners_img1, corners_img2, pointpairs, x_max, y_max, x_mean, y_mean)
 
-    points_img1 += corners_img1
-    points_img2 += corners_img2
-    return 
+def scale_coverage(shape, factor, canvas_shape):
+    """
+    Returns float mask of canvas size which is 1 where scale_image puts the pixels
+    of an image of shape and 0 in the padding.
+    """
+    height, width = scaled_size(shape, factor)
+    coverage = np.zeros(canvas_shape[0:2], dtype=np.float32)
+    coverage[0:height, 0:width] = 1.0
+    return coverage
 
 
-def scale(img1, img2, points_img1, points_img2):
+def output_factor(shape, max_size=None, max_megapixels=None):
     """
-    Prescales images and points to allow delaunay morphing of images of different sizes.
-    Upsacles the smaller image
+    Returns the factor an image of shape has to be resized by so its longest
+    side is at most max_size pixels and it has at most max_megapixels, 1.0 if it
+    fits already or no budget is given.
+    """
+    height, width = shape[0], shape[1]
+    factor = 1.0
+    if max_size is not None:
+        assert max_size > 0, "Maximum size has to be positive."
+        factor = min(factor, float(max_size) / max(height, width))
+    if max_megapixels is not None:
+        assert max_megapixels > 0, "Megapixel budget has to be positive."
+        factor = min(factor, (max_megapixels * 1e6 / (height * width)) ** 0.5)
+    return factor
+
+
+def scale_points(shape1, shape2, points_img1, points_img2, max_size=None, max_megapixels=None):
+    """
+    Prescales points of images of shape1 and shape2 like scale.
+    Returns scaled points as (N, 2) float32 arrays, the factors image 1 and
+    image 2 have to be resized by and the shape of the common canvas both images
+    are padded to.
+    Without budget the canvas has the size of the larger image. max_size and
+    max_megapixels shrink it and both factors by output_factor, so the morph
+    runs at the output resolution instead of the largest input's.
     """
-    y_size_img1, x_size_img1, z_size_img1 = img1.shape
-    y_size_img2, x_size_img2, z_size_img2 = img2.shape
+    y_size_img1, x_size_img1, z_size_img1 = shape1
+    y_size_img2, x_size_img2, z_size_img2 = shape2
     x_scale_factor = float(x_size_img1)/ float(x_size_img2)
     y_scale_factor = float(y_size_img1)/ float(y_size_img2)
+    factor1 = 1.0
+    factor2 = 1.0
+    # Scaled in double precision, rounded to float32 once
+    points_img1 = np.float64(as_points(points_img1))
+    points_img2 = np.float64(as_points(points_img2))
 
     # Images are of same size
     if x_size_img1 == x_size_img2 and y_size_img1 == y_size_img2:
-        return img1, img2, points_img1, points_img2
+        shape = tuple(shape1)
 
     # Image 1 is bigger
     elif x_size_img1 >= x_size_img2 and y_size_img1 >= y_size_img2:
-        temp_img = np.zeros(img1.shape, dtype=img1.dtype)
-        temp_points = []
+        shape = tuple(shape1)
         # X scale is smaller
         if x_scale_factor < y_scale_factor:
-            img2 = cv2.resize(img2,  (0,0), fx=x_scale_factor, fy=x_scale_factor, interpolation=cv2.INTER_LINEAR)
-            for point in points_img2:
-                x = point[0] * x_scale_factor
-                y = point[1] * x_scale_factor
-                temp_points.append((x,y))
+            factor2 = x_scale_factor
         # Y scale is smaller
         else:
-            img2 = cv2.resize(img2, (0,0), fx=y_scale_factor, fy=y_scale_factor, interpolation=cv2.INTER_LINEAR)
-            for point in points_img2:
-                x = point[0] * y_scale_factor
-                y = point[1] * y_scale_factor
-                temp_points.append((x,y))
-        temp_img[0:img2.shape[0], 0:img2.shape[1], 0:img2.shape[2]] = img2
-        points_img2 = temp_points
-        img2 = temp_img
+            factor2 = y_scale_factor
+        points_img2 = points_img2 * factor2
 
     # Image 1 is smaller
     elif x_size_img1 <= x_size_img2 and y_size_img1 <= y_size_img2:
-        temp_img = np.zeros(img2.shape, dtype=img2.dtype)
-        temp_points = []
+        shape = tuple(shape2)
         # X scale is smaller. we need the inverse
         if x_scale_factor > y_scale_factor:
-            img1 = cv2.resize(img1, (0,0), fx=(1/x_scale_factor), fy=(1/x_scale_factor), interpolation=cv2.INTER_LINEAR)
-            for point in points_img1:
-                x = point[0] * 1/x_scale_factor
-                y = point[1] * 1/x_scale_factor
-                temp_points.append((x,y))
+            points_img1 = points_img1 / x_scale_factor
+            factor1 = 1/x_scale_factor
         # Y scale is smaller
         else:
-            img1 = cv2.resize(img1, (0,0), fx=1/y_scale_factor, fy=1/y_scale_factor, interpolation=cv2.INTER_LINEAR)
-            for point in points_img1:
-                x = point[0] * 1/y_scale_factor
-                y = point[1] * 1/y_scale_factor
-                temp_points.append((x,y))
-        temp_img[0:img1.shape[0], 0:img1.shape[1], 0:img1.shape[2]] = img1
-        points_img1 = temp_points
-        img1 = temp_img
+            points_img1 = points_img1 / y_scale_factor
+            factor1 = 1/y_scale_factor
 
     # Images size relations are not the same i.e. x_scale < 1 and y_scale > 1 or vice versa
     else:
-        temp_img = np.zeros((max(y_size_img1, y_size_img2), max(x_size_img1, x_size_img2), max(z_size_img1, z_size_img2)), dtype=img1.dtype)
-        temp_img2 = np.copy(temp_img)
-        temp_img[0:img1.shape[0], 0:img1.shape[1], 0:img1.shape[2]] = img1
-        img1 = temp_img
-        temp_img2[0:img2.shape[0], 0:img2.shape[1], 0:img2.shape[2]] = img2
-        img2 = temp_img2
+        shape = (max(y_size_img1, y_size_img2), max(x_size_img1, x_size_img2), max(z_size_img1, z_size_img2))
 
-    return img1, img2, points_img1, points_img2
+    # Downscale canvas, factors and points to the output budget
+    budget = output_factor(shape, max_size, max_megapixels)
+    if budget < 1.0:
+        factor1 *= budget
+        factor2 *= budget
+        shape = scaled_size(shape, budget) + tuple(shape[2:])
+        # Rounding the canvas may cut off part of the last pixel, points stay inside it
+        last_pixel = (shape[1] - 1, shape[0] - 1)
+        points_img1 = np.minimum(points_img1 * budget, last_pixel)
+        points_img2 = np.minimum(points_img2 * budget, last_pixel)
 
+    return as_points(points_img1), as_points(points_img2), factor1, factor2, shape
+
+
+def scale_points_many(shapes, point_sets):
+    """
+    Prescales the points of images of shapes to one common canvas, see
+    scale_points. If one image is at least as large as all others in both
+    dimensions, it defines the canvas and every other image is upscaled to fit
+    it. Otherwise the canvas is the maximum of all sizes and nothing is scaled.
+    Returns scaled point sets as (N, 2) float32 arrays, the factor of every
+    image and the canvas shape.
+    """
+    heights = [shape[0] for shape in shapes]
+    widths = [shape[1] for shape in shapes]
+    largest = [i for i, shape in enumerate(shapes) if shape[0] == max(heights) and shape[1] == max(widths)]
+    if not largest:
+        shape = (max(heights), max(widths), max(shape[2] for shape in shapes))
+        return [as_points(points) for points in point_sets], [1.0] * len(shapes), shape
+
+    shape = tuple(shapes[largest[0]])
+    factors = []
+    scaled_sets = []
+    for image_shape, points in zip(shapes, point_sets):
+        factor = min(float(shape[1]) / float(image_shape[1]), float(shape[0]) / float(image_shape[0]))
+        factors.append(factor)
+        scaled_sets.append(as_points(np.float64(as_points(points)) * factor))
+    return scaled_sets, factors, shape
+
+
+def add_corners_many(shape, point_sets):
+    """
+    Adds corner points to the point sets of any number of images on a canvas of
+    shape, like add_corners does for two. For every canvas corner the point
+    nearest to it (by its mean position over all images) is taken and each
+    image's corner is offset by how far its point lies from the most extreme one,
+    so every pair of images gets the corners add_corners would roughly give it.
+    Returns the point sets with the corners appended as (N + 4, 2) float32 arrays.
+    """
+    x_max = shape[1] - 1
+    y_max = shape[0] - 1
+    corners = np.float64([(0, y_max), (x_max, y_max), (x_max, 0), (0, 0)])
+    positions = np.float64([as_points(points) for points in point_sets])
+    mean = positions.mean(axis=0)
+    nearest = np.argmin(np.abs(mean[:, np.newaxis] - corners).sum(axis=2), axis=0)
+    # Points nearest to the four corners in every image, (images, 4, 2)
+    selected = positions[:, nearest]
+    offsets = np.where(corners == 0, np.trunc(selected - selected.min(axis=0)),
+                       -np.trunc(selected.max(axis=0) - selected))
+    return [np.concatenate((as_points(points), np.float32(corners + offset)))
+            for points, offset in zip(point_sets, offsets)]
+
+
+def image_key(img):
+    """
+    Returns a digest of the pixels and shape of img, equal images get equal keys.
+    """
+    digest = hashlib.sha1(str(img.shape).encode())
+    digest.update(np.ascontiguousarray(img).data)
+    return digest.hexdigest()
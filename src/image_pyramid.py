@@ -0,0 +1,109 @@
+from collections import OrderedDict
+import cv2
+from image_delaunay_morphing import morph
+from image_delaunay_morphing import morph_iter
+from image_helpers import image_key
+
+
+def clamp(value, high):
+    """
+    Returns value limited to the pixel range 0 to high.
+    """
+    return max(0, min(value, high))
+
+
+class ImagePyramid(object):
+    """
+    Gaussian pyramid of an image, levels are built with cv2.pyrDown when first
+    requested and kept. Level 0 is the image itself, level n has half the size
+    of level n - 1. Pixel x of level 0 lies at x / 2**n on level n.
+    """
+
+    def __init__(self, img):
+        self.levels = [img]
+
+    def level(self, n):
+        """
+        Returns level n, building the missing levels up to it.
+        """
+        assert n >= 0, "Level has to be at least zero."
+        while len(self.levels) <= n:
+            last = self.levels[-1]
+            assert min(last.shape[0], last.shape[1]) > 1, "Image too small for level %d." % (n,)
+            self.levels.append(cv2.pyrDown(last))
+        return self.levels[n]
+
+    def level_for_size(self, max_size):
+        """
+        Returns the lowest level whose longest side is at most max_size.
+        """
+        height, width = self.levels[0].shape[0:2]
+        n = 0
+        while max(height, width) > max_size and min(height, width) > 1:
+            height, width = (height + 1) // 2, (width + 1) // 2
+            n += 1
+        return n
+
+    def to_level(self, points, n, integer=True):
+        """
+        Converts level 0 points to level n, rounded and clamped to integer pixels
+        inside it unless integer is False.
+        """
+        factor = 2.0 ** -n
+        if not integer:
+            return [(point[0] * factor, point[1] * factor) for point in points]
+        height, width = self.level(n).shape[0:2]
+        return [(clamp(int(round(point[0] * factor)), width - 1), clamp(int(round(point[1] * factor)), height - 1))
+                for point in points]
+
+    def from_level(self, points, n, integer=True):
+        """
+        Converts level n points to level 0, rounded and clamped to integer pixels
+        inside it unless integer is False. Mouse positions outside of a window
+        can be negative.
+        """
+        factor = 2.0 ** n
+        if not integer:
+            return [(point[0] * factor, point[1] * factor) for point in points]
+        height, width = self.levels[0].shape[0:2]
+        return [(clamp(int(round(point[0] * factor)), width - 1), clamp(int(round(point[1] * factor)), height - 1))
+                for point in points]
+
+
+class PyramidCache(object):
+    """
+    Pyramids of the least recently used max_images images, so display, corner
+    detection and previews of a loaded image share their levels. Images are
+    identified by image_key unless a key, e.g. the file name, is given.
+    """
+
+    def __init__(self, max_images=8):
+        self.max_images = max_images
+        self.pyramids = OrderedDict()
+
+    def get(self, img, key=None):
+        if key is None:
+            key = image_key(img)
+        if key in self.pyramids:
+            self.pyramids.move_to_end(key)
+            return self.pyramids[key]
+        pyramid = ImagePyramid(img)
+        self.pyramids[key] = pyramid
+        if len(self.pyramids) > self.max_images:
+            self.pyramids.popitem(last=False)
+        return pyramid
+
+
+def morph_preview(pyramid1, pyramid2, points_img1, points_img2, level=2, alpha=0.5, steps=2, stream=False,
+                  **kwargs):
+    """
+    Morphs level of both pyramids with the level 0 points converted to it, see
+    morph for the remaining arguments. Level n costs about 4**-n of a full
+    render. Returns the list of frames, or the morph_iter generator if stream.
+    """
+    img1, img2 = pyramid1.level(level), pyramid2.level(level)
+    points_img1 = pyramid1.to_level(points_img1, level)
+    points_img2 = pyramid2.to_level(points_img2, level)
+    if stream:
+        return morph_iter(img1, img2, points_img1, points_img2, alpha, steps, **kwargs)
+    return morph(img1, img2, points_img1, points_img2, alpha, steps, **kwargs)
@@ -0,0 +1,305 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+import numpy as np
+import cv2
+from batch_morph import validate_pair
+from image_delaunay_morphing import morph_iter
+
+
+class LRUCache(object):
+    """
+    Thread safe mapping which evicts the least recently used values once the
+    sizes of all values exceed max_bytes. hits and misses count lookups.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.values = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.values:
+                self.hits += 1
+                self.values.move_to_end(key)
+                return self.values[key][0]
+            self.misses += 1
+            return None
+
+    def put(self, key, value, size):
+        with self.lock:
+            if key in self.values:
+                self.bytes -= self.values.pop(key)[1]
+            self.values[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes and len(self.values) > 1:
+                self.bytes -= self.values.popitem(last=False)[1][1]
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.values), "bytes": self.bytes, "hits": self.hits, "misses": self.misses}
+
+
+class Overloaded(Exception):
+    pass
+
+
+class TooLarge(Exception):
+    pass
+
+
+def validate_request(request):
+    """
+    Raises ValueError unless request has the shape MorphService.morph expects,
+    so malformed requests are answered with 400 before they are queued.
+    """
+    if not isinstance(request, dict):
+        raise ValueError("Request has to be a JSON object")
+    validate_pair(request, ("image1", "image2"))
+    if request.get("engine", "triangles") not in ("triangles", "remap", "progressive"):
+        raise ValueError("Unknown engine %r" % (request.get("engine"),))
+
+
+class MorphService(object):
+    """
+    Morphs image files on a bounded thread pool for the HTTP front end.
+    Decoded images and the PNG encoded frames of each request, evicted
+    together, are kept in LRU caches, identical requests in flight are
+    computed once and shared. At most max_queue requests are pending or
+    running, more raise Overloaded.
+    """
+
+    def __init__(self, workers=2, max_queue=16, image_bytes=512 * 2 ** 20, frame_bytes=256 * 2 ** 20):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.max_queue = max_queue
+        self.images = LRUCache(image_bytes)
+        self.frames = LRUCache(frame_bytes)
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.coalesced = 0
+        self.completed = 0
+        self.failed = 0
+        self.latencies = deque(maxlen=1000)
+
+    def load_image(self, path):
+        """
+        Returns the decoded image at path, cached until the file changes.
+        """
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_mtime, stat.st_size)
+        img = self.images.get(key)
+        if img is None:
+            img = cv2.imread(path)
+            assert img is not None, "Image %s not readable" % (path,)
+            img.flags.writeable = False
+            self.images.put(key, img, img.nbytes)
+        return img
+
+    def request_key(self, request):
+        """
+        Returns the hex key of a request from the identity of both image files
+        and all morph arguments, so changed files get new keys.
+        """
+        digest = hashlib.sha1()
+        for name in ("image1", "image2"):
+            path = request[name]
+            stat = os.stat(path)
+            digest.update(repr((os.path.abspath(path), stat.st_mtime, stat.st_size)).encode())
+        for name in ("points1", "points2", "alpha", "steps", "engine"):
+            digest.update(repr(request.get(name)).encode())
+        return digest.hexdigest()
+
+    def render(self, key, request):
+        """
+        Morphs a request and returns its frames as list of PNG bytes. Raises
+        TooLarge once they exceed the frame cache, which stores a request's
+        frames as one entry.
+        """
+        img1 = self.load_image(request["image1"])
+        img2 = self.load_image(request["image2"])
+        points1 = [tuple(point) for point in request["points1"]]
+        points2 = [tuple(point) for point in request["points2"]]
+        pngs = []
+        size = 0
+        for frame in morph_iter(img1, img2, points1, points2, request.get("alpha", 0.5), request.get("steps", 2),
+                                request.get("engine", "triangles")):
+            ok, png = cv2.imencode(".png", frame)
+            assert ok, "Could not encode frame"
+            pngs.append(png.tobytes())
+            size += len(pngs[-1])
+            if size > self.frames.max_bytes:
+                raise TooLarge("Frames exceed the frame cache of %d bytes" % (self.frames.max_bytes,))
+        return pngs
+
+    def morph(self, request):
+        """
+        Morphs request, a dict like the pairs of batch_morph.read_manifest with
+        absolute paths and optional "engine", unless its frames are cached.
+        Returns the request key and number of frames, which are cached when it
+        returns. Raises ValueError for malformed requests and TooLarge when the
+        frames don't fit into the frame cache.
+        """
+        validate_request(request)
+        key = self.request_key(request)
+        pngs = self.frames.get(key)
+        if pngs is not None:
+            return key, len(pngs)
+
+        with self.lock:
+            future = self.inflight.get(key)
+            if future is not None:
+                self.coalesced += 1
+            else:
+                if len(self.inflight) >= self.max_queue:
+                    raise Overloaded("%d requests pending" % len(self.inflight))
+                future = self.executor.submit(self.timed_render, key, request)
+                self.inflight[key] = future
+        pngs = future.result()
+        # Stored here rather than in render, so frames evicted by other requests
+        # before this one answers are put back.
+        self.frames.put(key, pngs, sum(len(png) for png in pngs))
+        return key, len(pngs)
+
+    def timed_render(self, key, request):
+        """
+        Runs render on the pool, counts and times it and clears its in flight entry.
+        """
+        start = time.perf_counter()
+        try:
+            pngs = self.render(key, request)
+        except Exception:
+            with self.lock:
+                self.failed += 1
+            raise
+        else:
+            with self.lock:
+                self.completed += 1
+                self.latencies.append(time.perf_counter() - start)
+            return pngs
+        finally:
+            with self.lock:
+                del self.inflight[key]
+
+    def frame(self, key, index):
+        """
+        Returns the PNG of frame index of a morphed request or None if it isn't cached.
+        """
+        pngs = self.frames.get(key)
+        if pngs is None or index >= len(pngs):
+            return None
+        return pngs[index]
+
+    def metrics(self):
+        """
+        Returns queue depth, request counters, render latency statistics in
+        seconds and the stats of both caches as JSON serializable dict.
+        """
+        with self.lock:
+            latencies = np.float64(self.latencies)
+            metrics = {"queue_depth": len(self.inflight), "completed": self.completed, "failed": self.failed,
+                       "coalesced": self.coalesced}
+        if len(latencies):
+            metrics["latency"] = {"count": len(latencies), "mean": float(latencies.mean()),
+                                  "p50": float(np.percentile(latencies, 50)),
+                                  "p95": float(np.percentile(latencies, 95)), "max": float(latencies.max())}
+        metrics["images"] = self.images.stats()
+        metrics["frames"] = self.frames.stats()
+        return metrics
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+class MorphHandler(BaseHTTPRequestHandler):
+    """
+    POST /morph    JSON request of MorphService.morph, answers {"key", "frames"},
+                   413 if the frames don't fit into the frame cache
+    GET /frame/<key>/<index>    PNG of a frame
+    GET /metrics   JSON of MorphService.metrics
+    """
+
+    def send(self, status, body, content_type="application/json"):
+        if content_type == "application/json":
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path != "/morph":
+            return self.send(404, {"error": "not found"})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            key, count = self.server.service.morph(request)
+        except Overloaded as error:
+            return self.send(503, {"error": str(error)})
+        except TooLarge as error:
+            return self.send(413, {"error": str(error)})
+        except (ValueError, KeyError, AssertionError, OSError) as error:
+            return self.send(400, {"error": "%s: %s" % (type(error).__name__, error)})
+        except Exception as error:
+            return self.send(500, {"error": "%s: %s" % (type(error).__name__, error)})
+        self.send(200, {"key": key, "frames": count})
+
+    def do_GET(self):
+        parts = self.path.strip("/").split("/")
+        if parts == ["metrics"]:
+            return self.send(200, self.server.service.metrics())
+        if len(parts) == 3 and parts[0] == "frame" and parts[2].isdigit():
+            png = self.server.service.frame(parts[1], int(parts[2]))
+            if png is not None:
+                return self.send(200, png, "image/png")
+        self.send(404, {"error": "not found"})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(service, host="127.0.0.1", port=8080):
+    """
+    Returns a threading HTTP server for service, call serve_forever to run it.
+    Port 0 picks a free port, see server.server_address.
+    """
+    server = ThreadingHTTPServer((host, port), MorphHandler)
+    server.service = service
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve morphs over HTTP on localhost.")
+    parser.add_argument("-p", "--port", type=int, default=8080)
+    parser.add_argument("-w", "--workers", type=int, default=2, help="morph threads")
+    parser.add_argument("-q", "--max-queue", type=int, default=16, help="pending requests before 503")
+    parser.add_argument("--image-mb", type=int, default=512, help="decoded image cache size")
+    parser.add_argument("--frame-mb", type=int, default=256, help="PNG frame cache size")
+    args = parser.parse_args(argv)
+
+    service = MorphService(args.workers, args.max_queue, args.image_mb * 2 ** 20, args.frame_mb * 2 ** 20)
+    server = make_server(service, port=args.port)
+    print("Serving on http://%s:%d" % server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    service.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,205 @@
+import numpy as np
+import cv2
+from image_delaunay_morphing import TrianglePlan
+from image_delaunay_morphing import warp_triangle
+from image_delaunay_morphing import triangulate_points
+from image_delaunay_morphing import crop_frame
+from image_helpers import scale_points
+from image_helpers import scale_image
+from image_helpers import scale_coverage
+from image_helpers import as_points
+from image_helpers import get_crop_indices
+
+
+class MorphSession(object):
+    """
+    Morph of two images which is updated incrementally while points are added,
+    moved or deleted, for interactive editors.
+    The session keeps the triangles and the uncropped frames of the last update.
+    After an edit the points are triangulated again, which takes milliseconds,
+    and only the bounding rectangles of triangles that appeared or disappeared
+    are rendered again, each from all triangles intersecting it.
+    preview < 1 downscales both images by that factor first, points keep being
+    given in full resolution coordinates.
+    Triangles are kept in the order they first appeared, so frames equal a
+    full render of the current triangles in that order.
+    """
+
+    def __init__(self, img1, img2, points_img1, points_img2, alpha=0.5, steps=3, preview=1.0, dtype=np.float32):
+        assert 0 <= alpha <= 1, "Alpha not between 0 and 1."
+        assert steps > 1, "Number of steps has to be at least two."
+        assert 0 < preview <= 1, "Preview factor not between 0 and 1."
+        assert len(points_img1) == len(points_img2), "Point lists have different size."
+        self.alpha = alpha
+        self.preview = preview
+        self.points_img1 = list(points_img1)
+        self.points_img2 = list(points_img2)
+        self.weights = np.linspace(0.0, 1.0, num=steps)
+
+        if preview < 1:
+            img1 = cv2.resize(img1, (0, 0), fx=preview, fy=preview, interpolation=cv2.INTER_AREA)
+            img2 = cv2.resize(img2, (0, 0), fx=preview, fy=preview, interpolation=cv2.INTER_AREA)
+        factor1, factor2, shape = scale_points(img1.shape, img2.shape, [], [])[2:5]
+        self.factor1 = factor1 * preview
+        self.factor2 = factor2 * preview
+        self.shape = shape
+        self.img1 = scale_image(np.asarray(img1, dtype=dtype), factor1, shape)
+        self.img2 = scale_image(np.asarray(img2, dtype=dtype), factor2, shape)
+        self.coverage1 = scale_coverage(img1.shape, factor1, shape)
+        self.coverage2 = scale_coverage(img2.shape, factor2, shape)
+
+        # Triangles by key in render order
+        self.plans = {}
+        self.order = []
+        self.rects = np.zeros((0, 4), dtype=np.int64)
+        # Uncropped frames and the coverage of the first and last one
+        self.canvases = [np.zeros(shape, dtype=dtype) for a in self.weights]
+        self.covered = [np.zeros(shape[0:2], dtype=np.float32), np.zeros(shape[0:2], dtype=np.float32)]
+        self.crop = (0, shape[1], 0, shape[0])
+        self.rewarped = 0
+        if self.points_img1:
+            self.update()
+
+    def triangulate(self):
+        """
+        Returns key and corner lists of all delaunay triangles of the current points.
+        """
+        points_img1 = as_points(np.float64(as_points(self.points_img1)) * self.factor1)
+        points_img2 = as_points(np.float64(as_points(self.points_img2)) * self.factor2)
+        points_img1, points_img2, points, indices_tri = triangulate_points(points_img1, points_img2, self.shape,
+                                                                           self.alpha)
+        triangles = []
+        for t1, t2, t in zip(points_img1[indices_tri].tolist(), points_img2[indices_tri].tolist(),
+                             points[indices_tri].tolist()):
+            # Keyed by corners, independent of vertex order and point indices
+            key = tuple(sorted(zip(map(tuple, t), map(tuple, t1), map(tuple, t2))))
+            triangles.append((key, t1, t2, t))
+        return triangles
+
+    def update(self):
+        """
+        Triangulates the current points and renders the changed regions again.
+        Returns the number of triangle warps per frame this took.
+        """
+        assert len(self.points_img1) > 0, "Point lists are empty."
+        triangles = self.triangulate()
+        keys = set(key for key, t1, t2, t in triangles)
+        dirty = [self.plans[key].r for key in self.order if key not in keys]
+        for key in [key for key in self.order if key not in keys]:
+            del self.plans[key]
+        self.order = [key for key in self.order if key in keys]
+        added = [triangle for triangle in triangles if triangle[0] not in self.plans]
+        if added:
+            keys, t1, t2, t = zip(*added)
+            for key, plan in zip(keys, TrianglePlan.many(np.float32(t1), np.float32(t2), np.float32(t))):
+                self.plans[key] = plan
+                self.order.append(key)
+                dirty.append(plan.r)
+        self.rects = np.array([self.plans[key].r for key in self.order], dtype=np.int64).reshape(-1, 4)
+
+        self.rewarped = 0
+        dirty = merge_rects(dirty)
+        if sum(w * h for x, y, w, h in dirty) * 2 > self.shape[0] * self.shape[1]:
+            self.render_all()
+        else:
+            for rect in dirty:
+                self.render_rect(rect)
+        if dirty:
+            x_min_1, x_max_1, y_min_1, y_max_1 = get_crop_indices(self.covered[0])
+            x_min_2, x_max_2, y_min_2, y_max_2 = get_crop_indices(self.covered[1])
+            self.crop = (max(x_min_1, x_min_2), min(x_max_1, x_max_2), max(y_min_1, y_min_2),
+                         min(y_max_1, y_max_2))
+        return self.rewarped
+
+    def targets(self):
+        """
+        Returns sources, canvas and blend weight of every frame and of both coverage masks.
+        """
+        targets = [(self.img1, self.img2, canvas, a) for canvas, a in zip(self.canvases, self.weights)]
+        return targets + [(self.coverage1, None, self.covered[0], 0.0), (None, self.coverage2, self.covered[1], 1.0)]
+
+    def render_all(self):
+        """
+        Renders all frames from scratch, cheaper than many regions after large edits.
+        """
+        plans = [self.plans[key] for key in self.order]
+        self.rewarped += len(plans)
+        for img1, img2, canvas, a in self.targets():
+            canvas[:] = 0
+            for plan in plans:
+                warp_triangle(img1, img2, canvas, plan, a)
+
+    def render_rect(self, rect):
+        """
+        Renders the region rect of all frames again from the triangles
+        intersecting it. They are drawn into a scratch frame, which is only
+        allocated where they write, so pixels in rect get exactly the value a
+        full render gives them.
+        """
+        x, y, width, height = rect
+        ids = np.nonzero((self.rects[:, 0] < x + width) & (self.rects[:, 0] + self.rects[:, 2] > x) &
+                         (self.rects[:, 1] < y + height) & (self.rects[:, 1] + self.rects[:, 3] > y))[0]
+        plans = [self.plans[self.order[i]] for i in ids]
+        self.rewarped += len(plans)
+        region = (slice(y, y + height), slice(x, x + width))
+
+        for img1, img2, canvas, a in self.targets():
+            scratch = np.zeros(canvas.shape, dtype=canvas.dtype)
+            for plan in plans:
+                warp_triangle(img1, img2, scratch, plan, a)
+            canvas[region] = scratch[region]
+
+    def add_point(self, point_img1, point_img2):
+        """
+        Adds a pair of corresponding points and updates the frames. Returns its index.
+        """
+        self.points_img1.append(point_img1)
+        self.points_img2.append(point_img2)
+        self.update()
+        return len(self.points_img1) - 1
+
+    def move_point(self, index, point_img1=None, point_img2=None):
+        """
+        Moves point index in one or both images and updates the frames.
+        """
+        if point_img1 is not None:
+            self.points_img1[index] = point_img1
+        if point_img2 is not None:
+            self.points_img2[index] = point_img2
+        self.update()
+
+    def delete_point(self, index):
+        """
+        Deletes the pair of points index and updates the frames.
+        """
+        del self.points_img1[index]
+        del self.points_img2[index]
+        self.update()
+
+    def frames(self):
+        """
+        Returns the cropped uint8 frames, see morph.
+        """
+        return [crop_frame(canvas, self.crop) for canvas in self.canvases]
+
+
+def merge_rects(rects):
+    """
+    Returns the bounding rectangles of groups of overlapping rectangles.
+    """
+    merged = [tuple(rect) for rect in rects]
+    changed = True
+    while changed:
+        changed = False
+        result = []
+        for x, y, w, h in merged:
+            for i, (x2, y2, w2, h2) in enumerate(result):
+                if x < x2 + w2 and x2 < x + w and y < y2 + h2 and y2 < y + h:
+                    x_min, y_min = min(x, x2), min(y, y2)
+                    result[i] = (x_min, y_min, max(x + w, x2 + w2) - x_min, max(y + h, y2 + h2) - y_min)
+                    changed = True
+                    break
+            else:
+                result.append((x, y, w, h))
+        merged = result
+    return merged
@@ -0,0 +1,93 @@
+import argparse
+import json
+import sys
+import numpy as np
+import cv2
+from image_delaunay_morphing import morph_iter
+
+
+EASINGS = {
+    "linear": lambda t: t,
+    "ease_in": lambda t: t * t,
+    "ease_out": lambda t: t * (2.0 - t),
+    "ease_in_out": lambda t: t * t * (3.0 - 2.0 * t),
+    "sine": lambda t: 0.5 - 0.5 * np.cos(np.pi * t),
+}
+
+
+def frame_weights(steps, easing="linear", ping_pong=False):
+    """
+    Returns the blend weights of steps frames running from image 1 to image 2.
+    easing is a name of EASINGS or a function mapping evenly spaced times in
+    [0, 1] to weights in [0, 1]. With ping_pong the frames run back to image 1
+    afterwards, without repeating the last frame, so the video loops.
+    """
+    assert steps > 1, "Number of steps has to be at least two."
+    if not callable(easing):
+        assert easing in EASINGS, "Unknown easing %s." % (easing,)
+        easing = EASINGS[easing]
+    weights = np.clip(np.float64([easing(t) for t in np.linspace(0.0, 1.0, num=steps)]), 0.0, 1.0)
+    if ping_pong:
+        weights = np.concatenate((weights, weights[-2::-1]))
+    return weights
+
+
+def morph_to_video(path, img1, img2, points_img1, points_img2, alpha=0.5, steps=50, fps=25, codec="mp4v",
+                   easing="linear", ping_pong=False, engine="triangles", workers=1, dtype=np.float32,
+                   cache=None, max_size=None):
+    """
+    Morphs like morph and writes the frames to a video file at path as they are
+    rendered, without keeping them in memory. codec is a four character code of
+    cv2.VideoWriter. See frame_weights for easing and ping_pong. max_size limits
+    the longest side of the frames in pixels, large inputs are morphed at that
+    resolution.
+    Returns the number of frames written.
+    """
+    weights = frame_weights(steps, easing, ping_pong)
+    writer = None
+    count = 0
+    try:
+        for frame in morph_iter(img1, img2, points_img1, points_img2, alpha, steps, engine, workers, dtype,
+                                cache, weights, max_size):
+            # Frame size is only known after cropping
+            if writer is None:
+                writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*codec), fps,
+                                         (frame.shape[1], frame.shape[0]))
+                assert writer.isOpened(), "Could not open video %s with codec %s" % (path, codec)
+            writer.write(frame)
+            count += 1
+    finally:
+        if writer is not None:
+            writer.release()
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Morph two images into a video.")
+    parser.add_argument("image1")
+    parser.add_argument("image2")
+    parser.add_argument("points", help="JSON file {\"points1\": [[x, y], ...], \"points2\": [[x, y], ...]}")
+    parser.add_argument("output")
+    parser.add_argument("-s", "--steps", type=int, default=50)
+    parser.add_argument("-a", "--alpha", type=float, default=0.5)
+    parser.add_argument("--fps", type=float, default=25)
+    parser.add_argument("--codec", default="mp4v")
+    parser.add_argument("--easing", default="linear", choices=sorted(EASINGS))
+    parser.add_argument("--ping-pong", action="store_true")
+    parser.add_argument("--max-size", type=int, default=None, help="longest side of the video in pixels")
+    args = parser.parse_args(argv)
+
+    img1, img2 = cv2.imread(args.image1), cv2.imread(args.image2)
+    assert img1 is not None, "Image 1 not readable or not found"
+    assert img2 is not None, "Image 2 not readable or not found"
+    with open(args.points) as f:
+        points = json.load(f)
+    count = morph_to_video(args.output, img1, img2, [tuple(point) for point in points["points1"]],
+                           [tuple(point) for point in points["points2"]], args.alpha, args.steps, args.fps,
+                           args.codec, args.easing, args.ping_pong, max_size=args.max_size)
+    print("%d frames written to %s" % (count, args.output))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
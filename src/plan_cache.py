@@ -0,0 +1,119 @@
+import hashlib
+import os
+import tempfile
+import numpy as np
+from image_helpers import image_key
+from image_helpers import as_points
+
+
+class PlanCache(object):
+    """
+    Content addressed cache of the geometry morph computes before rendering:
+    scaled points, average points, triangle indices, scale factors, canvas shape
+    and crop window. Entries are .npz files in directory keyed by the hashes of
+    both images, the point lists, alpha and the engine. The least recently used
+    entries are deleted once the files exceed max_bytes.
+    hits and misses count the lookups of load.
+    """
+
+    def __init__(self, directory=None, max_bytes=64 * 2 ** 20):
+        if directory is None:
+            directory = os.path.join(tempfile.gettempdir(), "morph_plans")
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, img1, img2, points_img1, points_img2, alpha, engine, budget=(None, None)):
+        """
+        Returns the key of a morph of img1 and img2 with the given arguments.
+        budget is the max_size and max_megapixels of the morph. Point lists and
+        arrays of the same points get the same key.
+        """
+        digest = hashlib.sha1()
+        for part in (image_key(img1), image_key(img2), repr(float(alpha)), engine):
+            digest.update(part.encode())
+        digest.update(as_points(points_img1).tobytes())
+        digest.update(as_points(points_img2).tobytes())
+        # Only morphs with a budget hash it
+        if tuple(budget) != (None, None):
+            digest.update(repr(tuple(budget)).encode())
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def load(self, key):
+        """
+        Returns the prepare_points result and crop window stored under key or
+        None if there is no entry.
+        """
+        path = self.path(key)
+        try:
+            with np.load(path) as entry:
+                prepared = (as_points(entry["points_img1"]), as_points(entry["points_img2"]),
+                            as_points(entry["points"]), entry["indices_tri"], float(entry["factors"][0]), float(entry["factors"][1]),
+                            tuple(entry["shape"].tolist()))
+                crop = tuple(entry["crop"].tolist())
+        except (IOError, OSError, KeyError, ValueError):
+            self.misses += 1
+            return None
+        # Modification time orders entries for eviction
+        os.utime(path, None)
+        self.hits += 1
+        return prepared, crop
+
+    def store(self, key, prepared, crop):
+        """
+        Stores a prepare_points result and crop window under key and evicts the
+        least recently used entries above max_bytes.
+        """
+        points_img1, points_img2, points, indices_tri, factor1, factor2, shape = prepared
+        handle, temp_path = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        with os.fdopen(handle, "wb") as f:
+            np.savez_compressed(f, points_img1=as_points(points_img1), points_img2=as_points(points_img2),
+                                points=as_points(points), indices_tri=np.int32(indices_tri),
+                                factors=np.float64([factor1, factor2]), shape=np.int64(shape),
+                                crop=np.int64(crop))
+        # Renamed when complete, so concurrent readers never see partial files
+        os.replace(temp_path, self.path(key))
+        self.evict()
+
+    def entries(self):
+        """
+        Returns paths, sizes and modification times of all entries, oldest first.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".npz"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        return [(path, size, mtime) for mtime, size, path in entries]
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for path, size, mtime in entries)
+        for path, size, mtime in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def stats(self):
+        """
+        Returns hit and miss counts, number of entries and their total size in bytes.
+        """
+        entries = self.entries()
+        return {"hits": self.hits, "misses": self.misses, "entries": len(entries),
+                "bytes": sum(size for path, size, mtime in entries)}
@@ -0,0 +1,142 @@
+from collections import OrderedDict
+import numpy as np
+import cv2
+from image_helpers import image_key
+
+
+def create_detector(method="orb", features=2000):
+    """
+    Returns an ORB or AKAZE feature detector, both compute binary descriptors
+    which are matched with the hamming norm. AKAZE isn't part of every OpenCV
+    build, see available_methods.
+    """
+    assert method in available_methods(), "Method %s not available." % (method,)
+    if method == "orb":
+        return cv2.ORB_create(nfeatures=features)
+    return cv2.AKAZE_create()
+
+
+def available_methods():
+    """
+    Returns the detection methods the installed OpenCV provides.
+    """
+    return tuple(method for method, name in (("orb", "ORB_create"), ("akaze", "AKAZE_create")) if hasattr(cv2, name))
+
+
+class FeatureCache(object):
+    """
+    Keypoints and descriptors of the least recently used max_images images, so
+    one image can be matched against many others without detecting it again.
+    Images are identified by image_key unless a key is given.
+    """
+
+    def __init__(self, method="orb", features=2000, max_images=64):
+        self.method = method
+        self.features = features
+        self.max_images = max_images
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, img, key=None):
+        """
+        Returns keypoint positions as (N, 2) float32 array and descriptors of img.
+        Descriptors are None if no keypoints are found.
+        """
+        if key is None:
+            key = image_key(img)
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        entry = detect_features(img, self.method, self.features)
+        self.entries[key] = entry
+        if len(self.entries) > self.max_images:
+            self.entries.popitem(last=False)
+        return entry
+
+
+def detect_features(img, method="orb", features=2000):
+    """
+    Returns keypoint positions as (N, 2) float32 array and descriptors of img.
+    Descriptors are None if no keypoints are found.
+    """
+    detector = create_detector(method, features)
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    keypoints, descriptors = detector.detectAndCompute(gray, None)
+    positions = np.float32([keypoint.pt for keypoint in keypoints]).reshape(-1, 2)
+    return positions, descriptors
+
+
+def match_features(features1, features2, ratio=0.75, threshold=5.0, min_matches=8, matcher=None):
+    """
+    Matches descriptors with a ratio test and keeps the matches consistent with
+    a RANSAC homography. Returns matched positions of both images as (N, 2)
+    float32 arrays, empty if fewer than min_matches survive.
+    """
+    positions1, descriptors1 = features1
+    positions2, descriptors2 = features2
+    empty = np.zeros((0, 2), dtype=np.float32)
+    if descriptors1 is None or descriptors2 is None or len(descriptors1) < 2 or len(descriptors2) < 2:
+        return empty, empty
+
+    if matcher is None:
+        matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+    matches = [pair[0] for pair in matcher.knnMatch(descriptors1, descriptors2, k=2)
+               if len(pair) == 2 and pair[0].distance < ratio * pair[1].distance]
+    if len(matches) < max(4, min_matches):
+        return empty, empty
+    src = positions1[[m.queryIdx for m in matches]]
+    dst = positions2[[m.trainIdx for m in matches]]
+
+    homography, inliers = cv2.findHomography(src, dst, cv2.RANSAC, threshold)
+    if homography is None:
+        return empty, empty
+    inliers = inliers.ravel().astype(np.bool_)
+    if inliers.sum() < min_matches:
+        return empty, empty
+    return src[inliers], dst[inliers]
+
+
+def to_point_lists(positions1, positions2, max_points=None):
+    """
+    Rounds matched positions to the integer point lists morph takes. Pairs whose
+    rounded point repeats in either image are dropped, keeping the first one.
+    """
+    points1 = np.int64(np.rint(positions1))
+    points2 = np.int64(np.rint(positions2))
+    keep = np.ones(len(points1), dtype=np.bool_)
+    for points in (points1, points2):
+        keys = points[:, 1] * (points[:, 0].max(initial=0) + 1) + points[:, 0]
+        first = np.zeros(len(points1), dtype=np.bool_)
+        first[np.unique(keys, return_index=True)[1]] = True
+        keep &= first
+    points1, points2 = points1[keep][:max_points], points2[keep][:max_points]
+    return [tuple(int(v) for v in point) for point in points1], [tuple(int(v) for v in point) for point in points2]
+
+
+def find_points(img1, img2, cache=None, max_points=None, ratio=0.75, threshold=5.0, min_matches=8):
+    """
+    Finds corresponding points of img1 and img2 which can be passed to morph.
+    Returns two lists of (x, y) integer tuples, empty if the images don't match.
+    """
+    if cache is None:
+        cache = FeatureCache()
+    positions1, positions2 = match_features(cache.get(img1), cache.get(img2), ratio, threshold, min_matches)
+    return to_point_lists(positions1, positions2, max_points)
+
+
+def find_points_many(img1, images, cache=None, max_points=None, ratio=0.75, threshold=5.0, min_matches=8):
+    """
+    Matches img1 against every image of images, see find_points. Features of
+    img1 are detected once and all images are matched with the same matcher.
+    Yields a pair of point lists per image.
+    """
+    if cache is None:
+        cache = FeatureCache(max_images=2)
+    features1 = cache.get(img1)
+    matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+    for img2 in images:
+        positions1, positions2 = match_features(features1, cache.get(img2), ratio, threshold, min_matches, matcher)
+        yield to_point_lists(positions1, positions2, max_points)
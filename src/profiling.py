@@ -0,0 +1,158 @@
+import json
+import os
+import threading
+import time
+
+# Profiler recording the current morphs, None when profiling is disabled
+_active = None
+
+
+class NullStage(object):
+    """
+    Stage returned while profiling is disabled, it does nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add_bytes(self, nbytes):
+        pass
+
+
+NULL_STAGE = NullStage()
+
+
+class Stage(object):
+    """
+    Times one call of a pipeline stage and reports it to the profiler on exit.
+    """
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.nbytes = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, self.start, time.perf_counter(), self.nbytes)
+        return False
+
+    def add_bytes(self, nbytes):
+        """
+        Adds the size of arrays the stage allocated.
+        """
+        self.nbytes += nbytes
+
+
+def stage(name):
+    """
+    Returns a context manager timing the stage name of the active profiler, a
+    shared no-op one if profiling is disabled.
+    """
+    if _active is None:
+        return NULL_STAGE
+    return Stage(_active, name)
+
+
+def active():
+    """
+    Returns the active profiler or None.
+    """
+    return _active
+
+
+class Profiler(object):
+    """
+    Records wall time, calls and allocated bytes of the stages of all morphs run
+    inside its with block, on any thread, and per-triangle warp times:
+
+        with Profiler() as profiler:
+            morph(img1, img2, points_img1, points_img2)
+        profiler.write_chrome_trace("morph.json")
+
+    callback is called with every stage event dict as it is recorded.
+    Profilers don't nest, an inner one takes over until its block ends.
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.stages = {}
+        self.triangles = {}
+        self.events = []
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.previous = None
+
+    def __enter__(self):
+        global _active
+        self.previous = _active
+        _active = self
+        return self
+
+    def __exit__(self, *exc):
+        global _active
+        _active = self.previous
+        return False
+
+    def record(self, name, start, end, nbytes=0):
+        """
+        Records one call of stage name from start to end, perf_counter seconds.
+        """
+        event = {"name": name, "start": start - self.origin, "seconds": end - start, "bytes": nbytes,
+                 "thread": threading.current_thread().ident}
+        with self.lock:
+            totals = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0, "bytes": 0})
+            totals["calls"] += 1
+            totals["seconds"] += end - start
+            totals["bytes"] += nbytes
+            self.events.append(event)
+        if self.callback is not None:
+            self.callback(event)
+
+    def record_triangle(self, index, area, seconds):
+        """
+        Records one warp of triangle index with bounding rectangle area in pixels.
+        """
+        with self.lock:
+            totals = self.triangles.setdefault(index, {"area": area, "calls": 0, "seconds": 0.0})
+            totals["calls"] += 1
+            totals["seconds"] += seconds
+
+    def slowest_triangles(self, count=10):
+        """
+        Returns index and statistics of the count triangles with most warp time.
+        """
+        with self.lock:
+            triangles = sorted(self.triangles.items(), key=lambda item: -item[1]["seconds"])
+        return triangles[0:count]
+
+    def to_dict(self):
+        with self.lock:
+            return {"stages": dict((name, dict(totals)) for name, totals in self.stages.items()),
+                    "triangles": [dict(totals, index=index) for index, totals in sorted(self.triangles.items())]}
+
+    def write_json(self, path):
+        """
+        Writes stage totals and triangle statistics as JSON.
+        """
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    def write_chrome_trace(self, path):
+        """
+        Writes all stage events in the Chrome trace event format, viewable in
+        chrome://tracing or Perfetto.
+        """
+        pid = os.getpid()
+        with self.lock:
+            events = [{"name": event["name"], "ph": "X", "ts": event["start"] * 1e6, "dur": event["seconds"] * 1e6,
+                       "pid": pid, "tid": event["thread"], "args": {"bytes": event["bytes"]}}
+                      for event in self.events]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
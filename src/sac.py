@@ -1,12 +1,55 @@
 import cv2
 import numpy as np
+from functools import lru_cache
 
-def getPointFromRectangle(img1, point1, point2):
+@lru_cache(maxsize=64)
+def getGaussianWeights(rows, cols):
+	"""
+	Gaussian weight matrix of given size normalized to a maximum of one.
+	Matrices are cached by size and read only.
+	:param rows: number of rows
+	:param cols: number of columns
+	:return: weight matrix"""
+	gausCols = cv2.getGaussianKernel(cols, -1)
+	gausRows = cv2.getGaussianKernel(rows, -1)
+	gausMatrix = gausRows*gausCols.T
+	gausMatrixNormalized = gausMatrix/gausMatrix.max()
+	gausMatrixNormalized.flags.writeable = False
+	return gausMatrixNormalized
+
+def getCornerResponse(subimage):
+	"""
+	Computes gaussian weighted harris corner response of a color subimage.
+	:param subimage: subimage in which corners are searched
+	:return: corner response of every pixel"""
+	subimageGray = cv2.cvtColor(subimage, cv2.COLOR_BGR2GRAY)
+	subimageF = np.float32(subimageGray)
+	subimageF = cv2.normalize(subimageF, subimageF, 0, 1, cv2.NORM_MINMAX)
+	subimageF = cv2.GaussianBlur(subimageF, (5,5), 0)	
+	
+	# Detector parameters
+	blockSize = 2
+	apertureSize = 3
+	k = 0.04
+	# Detecting corners
+	corners = cv2.cornerHarris( subimageF, blockSize, apertureSize, k, cv2.BORDER_DEFAULT )
+
+	# Assume that user wants to mark point in middle of rectangle, hence weight cornes using gaussian
+	rows, cols = corners.shape
+	return corners * getGaussianWeights(rows, cols)
+
+def getPointFromRectangle(img1, point1, point2, pyramid=False, maxSize=64):
 	"""
 	Computes point of interest in a subimage which is defined by to given points.
+	In pyramid mode the corner is searched in the subimage downscaled to at most
+	maxSize pixels per side and refined with cv2.cornerSubPix at full resolution.
+	Downscaling reads a strided subsample of the subimage, so latency is almost
+	independent of the rectangle size.
 	:param img1: image in which point is searched
 	:param point1: corner of user drawn rectangle
 	:param point2: opposite corner of user drawn rectangle
+	:param pyramid: search downscaled and return float sub pixel coordinates
+	:param maxSize: maximum side length of the downscaled subimage
 	:return: point of interest in rectangle"""
 
 
@@ -18,27 +61,12 @@ def getPointFromRectangle(img1, point1, point2):
 	assert point1[0] != point2[0], "X cordinates of rectangle corners are equal -> no rectangle"
 	assert point1[1] != point2[1], "Y cordinates of rectangle corners are equal -> no rectangle"
 	
-	subimage = np.copy(img1[min(point1[1],point2[1]):max(point1[1],point2[1]), 
-										  min(point1[0], point2[0]):max(point1[0],point2[0])])
-	subimageGray = cv2.cvtColor(subimage, cv2.COLOR_BGR2GRAY)
-	subimageF = np.float32(subimageGray)
-	subimageF = cv2.normalize(subimageF, subimageF, 0, 1, cv2.NORM_MINMAX)
-	subimageF = cv2.GaussianBlur(subimageF, (5,5), 0)	
-	
-	# Detector parameters
-	blockSize = 2
-	apertureSize = 3
-	k = 0.04
-	# Detecting corners
-	corners = cv2.cornerHarris( subimageF, blockSize, apertureSize, k, cv2.BORDER_DEFAULT )
+	subimage = img1[min(point1[1],point2[1]):max(point1[1],point2[1]), 
+										  min(point1[0], point2[0]):max(point1[0],point2[0])]
+	if pyramid:
+		return getPointFromSubimagePyramid(subimage, min(point1[0], point2[0]), min(point1[1], point2[1]), maxSize)
 
-	# Assume that user wants to mark point in middle of rectangle, hence weight cornes using gaussian
-	rows, cols = corners.shape
-	gausCols = cv2.getGaussianKernel(cols, -1)
-	gausRows = cv2.getGaussianKernel(rows, -1)
-	gausMatrix = gausRows*gausCols.T
-	gausMatrixNormalized = gausMatrix/gausMatrix.max()
-	corners = corners * gausMatrixNormalized
+	corners = getCornerResponse(subimage)
 	
 	# get sharpest corners
 	i, j = np.where(corners == corners.max());
@@ -51,3 +79,65 @@ def getPointFromRectangle(img1, point1, point2):
 
 	return returnPoint
 
+def getPointFromSubimagePyramid(subimage, xOffset, yOffset, maxSize):
+	"""
+	Pyramid mode of getPointFromRectangle. The sharpest corner of the downscaled
+	subimage is followed through the finer levels within a small window around it
+	and refined to sub pixel accuracy at full resolution.
+	:param subimage: subimage in which point is searched
+	:param xOffset: x coordinate of subimage in image
+	:param yOffset: y coordinate of subimage in image
+	:param maxSize: maximum side length of the downscaled subimage
+	:return: float point of interest in image"""
+	rows, cols = subimage.shape[:2]
+	level = 0
+	while max(rows, cols) > maxSize * 2**level:
+		level += 1
+
+	# search whole subimage at coarsest level, candidate is kept in full resolution coordinates
+	x, y = getSharpestCorner(subimage, 2**level)
+
+	# follow candidate through the finer levels
+	for l in range(level - 1, -1, -1):
+		scale = 2**l
+		radius = 8 * scale
+		xStart, xEnd = max(0, int(round(x)) - radius), min(cols, int(round(x)) + radius + 1)
+		yStart, yEnd = max(0, int(round(y)) - radius), min(rows, int(round(y)) + radius + 1)
+		x, y = getSharpestCorner(subimage[yStart:yEnd, xStart:xEnd], scale)
+		x, y = x + xStart, y + yStart
+
+	# harris peaks lie slightly inside of corners, cornerSubPix moves them onto the corner.
+	# It needs the image to be larger than twice the search window plus 5 pixels
+	half = 5
+	xStart, xEnd = max(0, int(round(x)) - 3 * half), min(cols, int(round(x)) + 3 * half + 1)
+	yStart, yEnd = max(0, int(round(y)) - 3 * half), min(rows, int(round(y)) + 3 * half + 1)
+	half = min(half, (xEnd - xStart - 5) // 2, (yEnd - yStart - 5) // 2)
+	if half > 0:
+		window = np.float32(cv2.cvtColor(subimage[yStart:yEnd, xStart:xEnd], cv2.COLOR_BGR2GRAY))
+		point = np.float32([[x - xStart, y - yStart]])
+		criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 0.01)
+		cv2.cornerSubPix(window, point, (half, half), (-1, -1), criteria)
+		# keep harris candidate if refinement ran away
+		if abs(point[0, 0] + xStart - x) <= half and abs(point[0, 1] + yStart - y) <= half:
+			x, y = point[0, 0] + xStart, point[0, 1] + yStart
+
+	#add the start position of rectangle as offset
+	return (float(x + xOffset), float(y + yOffset))
+
+def getSharpestCorner(subimage, scale):
+	"""
+	Computes position of the sharpest corner of a subimage downscaled by scale.
+	Large scales average only every stride-th pixel of the subimage, 4 per output
+	pixel and axis, so the cost depends on the downscaled size only.
+	:param subimage: subimage in which corner is searched
+	:param scale: downscaling factor
+	:return: float position of corner in subimage coordinates"""
+	rows, cols = subimage.shape[:2]
+	small = subimage
+	if scale > 1:
+		stride = max(1, scale // 4)
+		small = cv2.resize(subimage[::stride, ::stride], (max(1, cols // scale), max(1, rows // scale)),
+			interpolation=cv2.INTER_AREA)
+	corners = getCornerResponse(small)
+	i, j = np.unravel_index(np.argmax(corners), corners.shape)
+	return (j + 0.5) * cols / small.shape[1] - 0.5, (i + 0.5) * rows / small.shape[0] - 0.5
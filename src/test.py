@@ -3,6 +3,9 @@ import cv2
 import sys
 import sac 
 from image_delaunay_morphing import morph
+from ui_worker import Worker
+from image_pyramid import ImagePyramid
+from image_pyramid import morph_preview
 
 img1 = None
 img2 = None
@@ -20,6 +23,13 @@ img2Orig = None
 pointsImg1 = []
 pointsImg2 = []
 
+# Pyramid levels shown in the windows, points are marked on copies of them
+displaySize = 1024
+pyramids = {}
+display = {}
+displayLevel = {}
+worker = None
+
 
 radiusSize = 0.003
 rectangleWitdh = 0.0008
@@ -28,10 +38,88 @@ def myFilledCircle(img, center):
 	thickness = -1
 	lineType = 8
 	shape = img.shape
-	radius = int((shape[0] + shape[1]) * radiusSize)
+	radius = max(1, int((shape[0] + shape[1]) * radiusSize))
 	cv2.circle (img, center, radius, (0,0,255), thickness, lineType)
 
 
+def toImage(point, imageSelect):
+	"""
+	Converts point from display to full resolution image coordinates.
+	"""
+	return pyramids[imageSelect].from_level([point], displayLevel[imageSelect])[0]
+
+
+def toDisplay(point, imageSelect):
+	"""
+	Converts point from full resolution image to display coordinates.
+	"""
+	return pyramids[imageSelect].to_level([point], displayLevel[imageSelect])[0]
+
+
+def findPoint(img, start, end):
+	"""
+	Corner detection running on the worker thread, a click marks the point directly.
+	"""
+	if start[0] == end[0] or start[1] == end[1]:
+		return start
+	x, y = sac.getPointFromRectangle(img, start, end, pyramid=True)
+	return (int(round(x)), int(round(y)))
+
+
+def addPoint(point, imageSelect):
+	"""
+	Stores a found point and marks it, called on the UI thread.
+	"""
+	if imageSelect:
+		pointsImg1.append(point)
+	else:
+		pointsImg2.append(point)
+	name = "Image 1" if imageSelect else "Image 2"
+	myFilledCircle(display[imageSelect], toDisplay(point, imageSelect))
+	cv2.imshow(name, display[imageSelect])
+	if len(pointsImg1) == len(pointsImg2) and pointsImg1:
+		requestPreview()
+
+
+def requestPreview():
+	"""
+	Morphs the displayed pyramid levels with the current points on the worker
+	thread. Older preview requests are dropped.
+	"""
+	level = max(displayLevel[True], displayLevel[False])
+	worker.submit(previewMorph, (level, list(pointsImg1), list(pointsImg2)), showPreview, key="preview")
+
+
+def previewMorph(level, points1, points2):
+	return morph_preview(pyramids[True], pyramids[False], points1, points2, level, 0.5, 3)[1]
+
+
+def showPreview(image):
+	cv2.imshow("Preview", image)
+
+
+def findPointFailed(error, point, imageSelect):
+	"""
+	Marks the clicked point instead of a corner the worker failed to find, so
+	the point lists stay paired.
+	"""
+	print ("Corner search failed, using the clicked point: %s: %s" % (type(error).__name__, error))
+	addPoint(point, imageSelect)
+
+
+def pollWorker():
+	"""
+	Shows finished worker results. A failed preview is only reported, so the
+	picked points are kept and picking goes on.
+	"""
+	while True:
+		try:
+			worker.poll()
+			return
+		except Exception as error:
+			print ("Worker job failed: %s: %s" % (type(error).__name__, error))
+
+
 dragStart = None
 rectangle = False
 waitingForSecondPoint = False
@@ -39,22 +127,16 @@ previousPoint = -1
 def onMouse(event, x, y, flags, imageSelect):
 	global dragStart, rectangle, rectangleWitdh, waitingForSecondPoint, previousPoint 
 	if imageSelect:
-		img1Temp = img1
-		img2Temp = img2
 		img1Name = "Image 1"
-		img2Name = "Image 2"
 	else:
-		img1Temp = img2
-		img2Temp = img1
 		img1Name = "Image 2"
-		img2Name = "Image 1"
 	
-	# Mouse movement, rectangle drawing
+	# Mouse movement, rectangle drawing on the display copy
 	if event == cv2.EVENT_MOUSEMOVE:
 		if rectangle == True:
-			img3 = img1Temp.copy()
+			img3 = display[imageSelect].copy()
 			shape = img3.shape
-			width = int((shape[0] + shape[1]) * rectangleWitdh)
+			width = max(1, int((shape[0] + shape[1]) * rectangleWitdh))
 			cv2.rectangle(img3, dragStart, (x, y), (50,255,50), width)
 			cv2.imshow(img1Name, img3)
 	# Left mouse button
@@ -71,21 +153,17 @@ def onMouse(event, x, y, flags, imageSelect):
 			previousPoint = imageSelect
 	elif event == cv2.EVENT_LBUTTONUP and rectangle is True:
 		dragEnd = x, y
-		if imageSelect:
-			# get point inside user drawn rectangle
-			point = sac.getPointFromRectangle(img1, dragStart, dragEnd)
-			pointsImg1.append(point)
-		else:
-			# get point inside user drawn rectangle
-			point = sac.getPointFromRectangle(img2, dragStart, dragEnd)
-			pointsImg2.append(point)
 		rectangle = False
-		myFilledCircle(img1Temp, point)
-		cv2.imshow(img1Name, img1Temp)
+		cv2.imshow(img1Name, display[imageSelect])
+		# get point inside user drawn rectangle without blocking the UI
+		img = img1 if imageSelect else img2
+		start = toImage(dragStart, imageSelect)
+		worker.submit(findPoint, (img, start, toImage(dragEnd, imageSelect)),
+			lambda point: addPoint(point, imageSelect), errback=lambda error: findPointFailed(error, start, imageSelect))
 	
 
 def test():
-	global img1, img2, img1Orig, img2Orig
+	global img1, img2, img1Orig, img2Orig, worker
 	"""
 	Test method for semiautomatic point corespondence.
 	"""
@@ -108,22 +186,31 @@ def test():
 
 	img1Orig= np.copy(img1)
 	img2Orig= np.copy(img2)
+	for imageSelect, img in ((True, img1Orig), (False, img2Orig)):
+		pyramids[imageSelect] = ImagePyramid(img)
+		displayLevel[imageSelect] = pyramids[imageSelect].level_for_size(displaySize)
+		display[imageSelect] = np.copy(pyramids[imageSelect].level(displayLevel[imageSelect]))
+	worker = Worker()
 
 	cv2.namedWindow("Image 1", cv2.WINDOW_KEEPRATIO)
 	cv2.namedWindow("Image 2", cv2.WINDOW_KEEPRATIO)
 	cv2.setMouseCallback("Image 1", onMouse, True)
 	cv2.setMouseCallback("Image 2", onMouse, False)
-	cv2.imshow("Image 1", img1)
-	cv2.imshow("Image 2", img2)
+	cv2.imshow("Image 1", display[True])
+	cv2.imshow("Image 2", display[False])
 	cv2.resizeWindow("Image 1", 640, 1024)
 	cv2.resizeWindow("Image 2", 640, 1024)
 
+	# Results of the worker are shown between polls of the event loop
 	key = 0
 	while key != 32:
-		key = cv2.waitKey(0)
+		key = cv2.waitKey(30)
+		pollWorker()
 		if key == 27:
 			cv2.destroyAllWindows() 
 			exit()
+	worker.stop()
+	pollWorker()
 	cv2.destroyAllWindows() 
 
 	#morph images
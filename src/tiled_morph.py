@@ -0,0 +1,284 @@
+import os
+import tempfile
+import numpy as np
+import cv2
+from image_delaunay_morphing import prepare_points
+from image_delaunay_morphing import TrianglePlan
+from image_helpers import grow_crop_window
+from image_helpers import scaled_size
+
+
+def linear_coords(start, stop, size, factor):
+    """
+    Returns source indices and weights of cv2.resize INTER_LINEAR for destination
+    indices start to stop along an axis of given source size.
+    """
+    f = (np.arange(start, stop) + 0.5) / factor - 0.5
+    s = np.floor(f)
+    f -= s
+    s = np.int64(s)
+    f[s < 0] = 0
+    s[s < 0] = 0
+    over = s >= size - 1
+    f[over] = 0
+    s[over] = size - 1
+    return s, np.float32(f)
+
+
+def resize_tile(img, factor, y_start, y_end, x_start, x_end):
+    """
+    Returns the tile [y_start:y_end, x_start:x_end] of img resized by factor as float
+    image, reading only the source pixels the tile depends on.
+    """
+    if factor == 1.0:
+        return np.float32(img[y_start:y_end, x_start:x_end])
+    rows, fy = linear_coords(y_start, y_end, img.shape[0], factor)
+    cols, fx = linear_coords(x_start, x_end, img.shape[1], factor)
+    rows_next = np.minimum(rows + 1, img.shape[0] - 1)
+    cols_next = np.minimum(cols + 1, img.shape[1] - 1)
+    top = np.float32(img[np.ix_(rows, cols)])
+    top += (np.float32(img[np.ix_(rows_next, cols)]) - top) * fy[:, np.newaxis, np.newaxis]
+    bottom = np.float32(img[np.ix_(rows, cols_next)])
+    bottom += (np.float32(img[np.ix_(rows_next, cols_next)]) - bottom) * fy[:, np.newaxis, np.newaxis]
+    return top + (bottom - top) * fx[np.newaxis, :, np.newaxis]
+
+
+def tiles(shape, tile_size):
+    """
+    Yields y_start, y_end, x_start, x_end of all tiles covering shape.
+    """
+    for y in range(0, shape[0], tile_size):
+        for x in range(0, shape[1], tile_size):
+            yield y, min(y + tile_size, shape[0]), x, min(x + tile_size, shape[1])
+
+
+def create_npy(path, dtype, shape):
+    """
+    Creates a zero filled .npy file without keeping it mapped.
+    """
+    np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape).flush()
+
+
+def write_canvas(path, img, factor, shape, tile_size):
+    """
+    Writes img resized by factor and padded to shape into a uint8 .npy file, tile
+    by tile. The canvas gets an extra channel which is 255 inside the image and 0
+    in the padding, like the coverage masks of morph.
+    """
+    canvas = np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8, shape=(shape[0], shape[1], shape[2] + 1))
+    height, width = scaled_size(img.shape, factor)
+    channels = img.shape[2]
+    for y_start, y_end, x_start, x_end in tiles((height, width), tile_size):
+        tile = resize_tile(img, factor, y_start, y_end, x_start, x_end)
+        canvas[y_start:y_end, x_start:x_end, 0:channels] = np.uint8(np.clip(np.rint(tile), 0, 255))
+        canvas[y_start:y_end, x_start:x_end, shape[2]] = 255
+    canvas.flush()
+    del canvas
+
+
+def owner_spans(triangles):
+    """
+    Returns for every triangle the first and last + 1 column it fills in each row
+    of its bounding rectangle, in canvas coordinates, as int32 arrays.
+    Masks of morph are binary and every triangle is rasterized inside its own
+    bounding rectangle, as clipping it to a tile would change its rasterization.
+    A filled convex polygon has one span per row, so each triangle is rasterized
+    once and only its spans are kept.
+    """
+    spans = []
+    for plan in triangles:
+        r = plan.r
+        mask = np.zeros((r[3], r[2]), dtype=np.uint8)
+        cv2.fillConvexPoly(mask, np.int32(plan.t_rect), 1)
+        filled = mask.any(axis=1)
+        begin = np.where(filled, np.argmax(mask, axis=1), 0)
+        end = np.where(filled, r[2] - np.argmax(mask[:, ::-1], axis=1), 0)
+        spans.append((np.int32(begin + r[0]), np.int32(end + r[0])))
+    return spans
+
+
+def owner_tile(triangles, spans, ids, y_start, y_end, x_start, x_end):
+    """
+    Returns the id (index + 1) of the triangle each pixel of the tile is taken
+    from as int32 array, 0 outside of all triangles. ids are the intersecting
+    triangles in order, later triangles overwrite earlier ones like in morph.
+    """
+    owners = np.zeros((y_end - y_start, x_end - x_start), dtype=np.int32)
+    cols = np.arange(x_start, x_end)
+    for i in ids:
+        r = triangles[i - 1].r
+        row_start, row_end = max(y_start, r[1]), min(y_end, r[1] + r[3])
+        begin, end = spans[i - 1]
+        begin = begin[row_start - r[1]:row_end - r[1], np.newaxis]
+        end = end[row_start - r[1]:row_end - r[1], np.newaxis]
+        owners[row_start - y_start:row_end - y_start][(cols >= begin) & (cols < end)] = i
+    return owners
+
+
+def intersecting(rects, y_start, y_end, x_start, x_end):
+    """
+    Returns the ids (index + 1) of all rectangles intersecting the tile in order.
+    """
+    return 1 + np.nonzero((rects[:, 0] < x_end) & (rects[:, 0] + rects[:, 2] > x_start) &
+                          (rects[:, 1] < y_end) & (rects[:, 1] + rects[:, 3] > y_start))[0]
+
+
+def write_tile(path, tile, y_start, x_start):
+    """
+    Writes tile into the .npy file at path at y_start, x_start, converted to its dtype.
+    The file is only mapped for this write, so its pages don't stay resident.
+    Unmapping leaves writing the dirty pages back to the kernel, syncing every
+    tile would stall on the disk.
+    """
+    out = np.load(path, mmap_mode="r+")
+    out[y_start:y_start + tile.shape[0], x_start:x_start + tile.shape[1]] = tile
+    del out
+
+
+def source_window(inverse, rect, patch_size, pad=2):
+    """
+    Returns the part x0, y0, x1, y1 of a source rectangle of size rect[2], rect[3]
+    that the inverse warp maps the destination patch of patch_size onto, grown by
+    pad pixels for interpolation and clamped to the rectangle. Clamped sides
+    coincide with the rectangle, so border reflection is unchanged.
+    """
+    width, height = patch_size
+    corners = np.float64([(0, 0), (width - 1, 0), (0, height - 1), (width - 1, height - 1)])
+    source = corners.dot(inverse[:, 0:2].T) + inverse[:, 2]
+    x0, y0 = np.floor(source.min(axis=0)).astype(int) - pad
+    x1, y1 = np.ceil(source.max(axis=0)).astype(int) + pad + 1
+    x0, y0 = min(max(x0, 0), rect[2] - 1), min(max(y0, 0), rect[3] - 1)
+    x1, y1 = max(min(x1, rect[2]), x0 + 1), max(min(y1, rect[3]), y0 + 1)
+    return x0, y0, x1, y1
+
+
+def warp_window(canvas, warp_mat, rect, offset, patch_size):
+    """
+    Warps the patch of patch_size at offset inside the destination rectangle
+    from rect of canvas, reading only the source window the patch depends on.
+    The inverse warp is shifted by whole pixels, so sampling positions are those
+    of warping the whole rectangle.
+    """
+    warp_mat = np.copy(warp_mat)
+    warp_mat[:, 2] -= offset
+    inverse = cv2.invertAffineTransform(warp_mat)
+    x0, y0, x1, y1 = source_window(inverse, rect, patch_size)
+    inverse[:, 2] -= (x0, y0)
+    src = canvas[rect[1] + y0:rect[1] + y1, rect[0] + x0:rect[0] + x1]
+    return cv2.warpAffine(src, inverse, patch_size, None, flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                          borderMode=cv2.BORDER_REFLECT_101)
+
+
+def warp_tile(canvas1, canvas2, owners, triangles, ids, y_start, y_end, x_start, x_end):
+    """
+    Warps the pixels of one output tile from both canvases, using the triangles
+    with the given ids, which intersect the tile, and the owner_tile of the tile.
+    Every pixel is warped once and blended into every frame by blend_tile.
+    Only the source windows mapped onto the tile are read, so work and memory
+    per tile follow the tile size rather than the size of the triangles.
+    Returns both warped float tiles, 0 outside of all triangles, and the
+    coverage of the first and last frame.
+    """
+    channels = canvas1.shape[2] - 1
+    warped1 = np.zeros((y_end - y_start, x_end - x_start, channels + 1), dtype=np.float32)
+    warped2 = np.zeros_like(warped1)
+    for i in ids:
+        plan = triangles[i - 1]
+        r = plan.r
+        # Part of the triangle rectangle inside the tile
+        ix_start, ix_end = max(x_start, r[0]), min(x_end, r[0] + r[2])
+        iy_start, iy_end = max(y_start, r[1]), min(y_end, r[1] + r[3])
+        patch = (slice(iy_start - y_start, iy_end - y_start), slice(ix_start - x_start, ix_end - x_start))
+        mask = owners[patch] == i
+        if not mask.any():
+            continue
+        offset = np.float32([ix_start - r[0], iy_start - r[1]])
+        patch_size = (ix_end - ix_start, iy_end - iy_start)
+
+        warp_image1 = warp_window(canvas1, plan.warp_mat1, plan.r1, offset, patch_size)
+        warp_image2 = warp_window(canvas2, plan.warp_mat2, plan.r2, offset, patch_size)
+        np.copyto(warped1[patch], warp_image1, where=mask[:, :, np.newaxis])
+        np.copyto(warped2[patch], warp_image2, where=mask[:, :, np.newaxis])
+
+    # The extra canvas channel tells where the first and last frame show the images
+    coverage = [warped1[:, :, channels] > 0, warped2[:, :, channels] > 0]
+    return warped1[:, :, 0:channels], warped2[:, :, 0:channels], coverage
+
+
+def blend_tile(warped1, warped2, a, img):
+    """
+    Blends the warped tiles of warp_tile with weight a into the float tile img
+    and returns it, so one buffer is reused for all frames.
+    """
+    np.multiply(warped1, 1.0 - a, out=img)
+    img += a * warped2
+    return img
+
+
+def morph_tiled(img1, img2, points_img1, points_img2, alpha=0.5, steps=2, directory=None, tile_size=512):
+    """
+    Morphs images too large for memory, see morph.
+    img1 and img2 are uint8 arrays, usually np.memmap. Scaled sources, frames and
+    coverage masks are .npy files in directory (a new temporary directory by
+    default) and output tiles are rendered from the triangles intersecting them,
+    so only tile sized float buffers are held in memory: the warped pixels of the
+    current tile and one frame tile, which is written as soon as it is blended.
+    Memory doesn't grow with steps. Source reads are cropped to what maps onto
+    the tile, only owner_spans briefly holds a uint8 mask of one triangle's
+    bounding rectangle at a time.
+    Returns the cropped frames as read only np.memmap arrays.
+    Frames match morph within one grey level, source warps are rounded to uint8.
+    """
+    assert steps > 1, "Number of steps has to be at least two."
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix="morph_")
+
+    points_img1, points_img2, points, indices_tri, factor1, factor2, shape = prepare_points(
+        img1.shape, img2.shape, points_img1, points_img2, alpha)
+
+    canvas_paths = [os.path.join(directory, "canvas%d.npy" % i) for i in (1, 2)]
+    write_canvas(canvas_paths[0], img1, factor1, shape, tile_size)
+    write_canvas(canvas_paths[1], img2, factor2, shape, tile_size)
+
+    frame_paths = [os.path.join(directory, "frame_%04d.npy" % i) for i in range(0, steps)]
+    for path in frame_paths:
+        create_npy(path, np.uint8, shape)
+    coverage_paths = [os.path.join(directory, "coverage%d.npy" % i) for i in (1, 2)]
+    for path in coverage_paths:
+        create_npy(path, np.bool_, shape[0:2])
+
+    triangles = TrianglePlan.many(points_img1[indices_tri], points_img2[indices_tri], points[indices_tri], mask=False)
+    rects = np.array([plan.r for plan in triangles]).reshape(-1, 4)
+    spans = owner_spans(triangles)
+
+    alphas = np.linspace(0.0, 1.0, num=steps)
+    for y_start, y_end, x_start, x_end in tiles(shape, tile_size):
+        # Files are mapped per tile, so only pages of the current tile stay resident
+        canvas1 = np.load(canvas_paths[0], mmap_mode="r")
+        canvas2 = np.load(canvas_paths[1], mmap_mode="r")
+        ids = intersecting(rects, y_start, y_end, x_start, x_end)
+        owners = owner_tile(triangles, spans, ids, y_start, y_end, x_start, x_end)
+        warped1, warped2, coverage = warp_tile(canvas1, canvas2, owners, triangles, ids,
+                                               y_start, y_end, x_start, x_end)
+        del canvas1, canvas2
+
+        img = np.empty((y_end - y_start, x_end - x_start, shape[2]), dtype=np.float32)
+        for path, a in zip(frame_paths, alphas):
+            write_tile(path, blend_tile(warped1, warped2, a, img), y_start, x_start)
+        for path, tile in zip(coverage_paths, coverage):
+            write_tile(path, tile, y_start, x_start)
+
+    for path in canvas_paths:
+        os.remove(path)
+
+    # Crop images
+    # Either first or last image needs max crop
+    crops = []
+    for path in coverage_paths:
+        covered = np.load(path, mmap_mode="r")
+        crops.append(grow_crop_window(lambda y0, y1, x0, x1: not covered[y0:y1, x0:x1].all(), shape[0], shape[1]))
+        del covered
+        os.remove(path)
+    (x_min_1, x_max_1, y_min_1, y_max_1), (x_min_2, x_max_2, y_min_2, y_max_2) = crops
+    x_min, x_max, y_min, y_max = max(x_min_1, x_min_2), min(x_max_1, x_max_2), max(y_min_1, y_min_2), min(y_max_1, y_max_2)
+    return [np.load(path, mmap_mode="r")[y_min:y_max, x_min:x_max] for path in frame_paths]
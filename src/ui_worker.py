@@ -0,0 +1,80 @@
+import queue
+import threading
+
+
+class Worker(object):
+    """
+    Runs jobs of an interactive front end on one background thread in
+    submission order and hands their results back to the UI thread, which calls
+    poll regularly, e.g. between cv2.waitKey calls. GUI functions are then only
+    called from the UI thread.
+    Jobs submitted with a key replace the pending job of the same key, and the
+    result of a job is dropped if a newer job with its key was submitted in the
+    meantime, so only the latest preview gets rendered and shown.
+    """
+
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+        self.lock = threading.Lock()
+        # Newest generation submitted per key
+        self.generations = {}
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, fn, args=(), callback=None, key=None, errback=None):
+        """
+        Queues fn(*args), callback(result) is called by poll on success and
+        errback(error) on failure.
+        """
+        with self.lock:
+            generation = self.generations.get(key, 0) + 1
+            if key is not None:
+                self.generations[key] = generation
+        self.jobs.put((fn, args, callback, errback, key, generation))
+
+    def stale(self, key, generation):
+        with self.lock:
+            return key is not None and self.generations.get(key) != generation
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            fn, args, callback, errback, key, generation = job
+            if self.stale(key, generation):
+                continue
+            try:
+                self.results.put((callback, errback, fn(*args), None, key, generation))
+            except Exception as error:
+                self.results.put((callback, errback, None, error, key, generation))
+
+    def poll(self):
+        """
+        Calls the callbacks of all finished, current jobs. Errors of jobs are
+        passed to their errback or raised here if they have none. Returns the
+        number of callbacks and errbacks called.
+        """
+        called = 0
+        while True:
+            try:
+                callback, errback, result, error, key, generation = self.results.get_nowait()
+            except queue.Empty:
+                return called
+            if error is not None and errback is None:
+                raise error
+            if self.stale(key, generation):
+                continue
+            if error is not None:
+                errback(error)
+            elif callback is None:
+                continue
+            else:
+                callback(result)
+            called += 1
+
+    def stop(self):
+        self.jobs.put(None)
+        self.thread.join()
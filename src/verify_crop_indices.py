@@ -0,0 +1,160 @@
+import argparse
+import sys
+import numpy as np
+import cv2
+from image_helpers import get_crop_indices
+
+
+def reference_crop_indices(img):
+    """
+    The original pixel by pixel get_crop_indices, kept to verify the summed
+    area table version against it. Needs step sizes of at least one pixel,
+    i.e. images of at least 50 pixels per side.
+    Pixel values are summed as Python ints. The original summed numpy scalars,
+    which wraps around at 256 for uint8 images and took e.g. (128, 128, 0)
+    for black. Morph called it on float images only.
+    """
+    x_min= int(img.shape[1] / 2) - 1
+    y_min= int(img.shape[0] / 2) - 1
+    x_max= int(img.shape[1] / 2) + 1
+    y_max= int(img.shape[0] / 2) + 1
+
+    x_step_size = int((img.shape[1]/100) * 2)
+    y_step_size = int((img.shape[0]/100) * 2)
+
+    top_done = False
+    left_done = False
+    bottom_done = False
+    right_done = False
+
+    while not top_done or not right_done or not bottom_done or not left_done:
+        # check left
+        if not left_done and x_min - x_step_size > -1:
+            for y in range(y_min, y_max):
+                value = img[y, x_min - x_step_size, :].tolist()
+                if sum(value) == 0:
+                    left_done = True
+                    break
+            if y == y_max -1 :
+                left_done = False
+                x_min -= x_step_size
+        else:
+            left_done = True
+
+        # check bottom
+        if not bottom_done and y_max + y_step_size < img.shape[0] :
+            for x in range(x_min, x_max):
+                value = img[y_max + y_step_size, x, :].tolist()
+                if sum(value) ==  0:
+                    bottom_done = True
+                    break
+            if x == x_max - 1:
+                bottom_done = False
+                y_max += y_step_size
+        else:
+            bottom_done = True
+
+        # check right
+        if not right_done and x_max + x_step_size < img.shape[1] :
+            for y in range(y_min, y_max):
+                value = img[y, x_max + x_step_size, :].tolist()
+                if sum(value) == 0:
+                    right_done = True
+                    break
+            if y == y_max - 1:
+                right_done = False
+                x_max += x_step_size
+        else:
+            right_done = True
+
+        # check top
+        if not top_done and y_min - y_step_size > -1:
+            for x in range(x_min, x_max):
+                value = img[y_min - y_step_size, x , :].tolist()
+                if sum(value) == 0:
+                    top_done = True
+                    break
+            if x == x_max - 1:
+                top_done = False
+                y_min -= y_step_size
+        else:
+            top_done = True
+
+    return x_min, x_max, y_min, y_max
+
+
+def irregular_border(rng, width, height):
+    """
+    Returns a uint8 image of given size whose content is a random polygon
+    around the centre on black, with black speckles inside and bright speckles
+    in the border. The 2x2 centre crop get_crop_indices starts from is kept
+    free of black pixels.
+    """
+    img = np.zeros((height, width, 3), dtype=np.uint8)
+    count = rng.randint(5, 12)
+    angles = np.sort(rng.uniform(0, 2 * np.pi, count))
+    radii = rng.uniform(0.3, 0.75, count)
+    polygon = np.int32(np.stack((width / 2.0 + np.cos(angles) * radii * width,
+                                 height / 2.0 + np.sin(angles) * radii * height), axis=1))
+    cv2.fillPoly(img, [polygon], (1, 1, 1))
+    texture = np.uint8(rng.randint(1, 256, (height, width, 3)))
+    img *= texture
+
+    # Black speckles, also single channel zeros which are not black
+    for i in range(0, rng.randint(0, 6)):
+        x, y = rng.randint(0, width), rng.randint(0, height)
+        size = rng.randint(1, 4)
+        img[y:y + size, x:x + size] = 0
+    for i in range(0, rng.randint(0, 6)):
+        img[rng.randint(0, height), rng.randint(0, width), rng.randint(0, 3)] = 0
+    # Bright speckles in the border
+    for i in range(0, rng.randint(0, 6)):
+        img[rng.randint(0, height), rng.randint(0, width)] = 255
+
+    centre_x, centre_y = int(width / 2), int(height / 2)
+    img[centre_y - 1:centre_y + 1, centre_x - 1:centre_x + 1] = 128
+    return img
+
+
+def verify(count=200, seed=0, min_size=50, max_size=700):
+    """
+    Compares get_crop_indices with reference_crop_indices on count seeded
+    irregular borders as uint8 and float32 and checks that the window of
+    exact=True contains no black pixel. Returns a list of failure messages.
+    """
+    rng = np.random.RandomState(seed)
+    failures = []
+    for i in range(0, count):
+        width, height = rng.randint(min_size, max_size + 1, 2)
+        img = irregular_border(rng, width, height)
+        for dtype in (np.uint8, np.float32):
+            typed = img.astype(dtype)
+            expected = reference_crop_indices(typed)
+            result = get_crop_indices(typed)
+            if tuple(result) != tuple(expected):
+                failures.append("image %d %s %dx%d: %s instead of %s" % (
+                    i, np.dtype(dtype).name, width, height, result, expected))
+
+            x_min, x_max, y_min, y_max = get_crop_indices(typed, exact=True)
+            window = typed[y_min:y_max, x_min:x_max]
+            if (window == 0).all(axis=2).any():
+                failures.append("image %d %s %dx%d: exact window %s contains black pixels" % (
+                    i, np.dtype(dtype).name, width, height, (x_min, x_max, y_min, y_max)))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Verify get_crop_indices against the original loop.")
+    parser.add_argument("-n", "--count", type=int, default=200, help="number of synthetic images")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    failures = verify(args.count, args.seed)
+    for failure in failures:
+        print(failure)
+    print("%d images, %d failures" % (args.count, len(failures)))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,59 @@
+import argparse
+import sys
+import numpy as np
+import cv2
+from benchmark_morph import synthetic_pair
+from image_delaunay_morphing import sequence_renderers
+
+
+def coherent_sequence(count, width=640, height=480, points=40, seed=0):
+    """
+    Returns count images of one synthetic scene seen under seeded random
+    similarity transforms and the point lists of the same landmarks in each.
+    """
+    rng = np.random.RandomState(seed)
+    base, _, base_points, _ = synthetic_pair(width, height, points, seed)
+    images = []
+    point_sets = []
+    for i in range(0, count):
+        warp_mat = cv2.getRotationMatrix2D((width / 2.0, height / 2.0), rng.uniform(-8, 8), rng.uniform(0.9, 1.1))
+        warp_mat[:, 2] += rng.uniform(-20, 20, 2)
+        images.append(cv2.warpAffine(base, warp_mat, (width, height)))
+        moved = np.float64(base_points).dot(warp_mat[:, 0:2].T) + warp_mat[:, 2]
+        point_sets.append([(int(min(max(x, 0), width - 1)), int(min(max(y, 0), height - 1))) for x, y in moved])
+    return images, point_sets
+
+
+def verify(count=4, seeds=(0, 1, 2), alphas=(0.0, 0.5, 1.0)):
+    """
+    Checks for coherent sequences that the frame of weight 1 of every segment
+    of morph_sequence equals the frame of weight 0 of the next one, which is
+    the join frame morph_sequence yields only once. Returns failure messages.
+    """
+    failures = []
+    for seed in seeds:
+        images, point_sets = coherent_sequence(count, seed=seed)
+        for alpha in alphas:
+            renders = list(sequence_renderers(images, point_sets, alpha))
+            for i in range(0, len(renders) - 1):
+                last, first = renders[i](1.0), renders[i + 1](0.0)
+                if not np.array_equal(last, first):
+                    failures.append("seed %d alpha %.2f: join %d differs by %.2f grey levels on average" % (
+                        seed, alpha, i + 1, np.abs(np.int16(last) - np.int16(first)).mean()))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Verify that morph_sequence segments meet at the joins.")
+    parser.add_argument("-n", "--count", type=int, default=4, help="images per sequence")
+    args = parser.parse_args(argv)
+
+    failures = verify(args.count)
+    for failure in failures:
+        print(failure)
+    print("%d failures" % len(failures))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
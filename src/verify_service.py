@@ -0,0 +1,199 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+import numpy as np
+import cv2
+from benchmark_morph import synthetic_pair
+from morph_service import MorphService
+from morph_service import make_server
+
+
+class GatedService(MorphService):
+    """
+    MorphService whose renders wait for gate, so requests stay in flight
+    until the check releases them.
+    """
+
+    def __init__(self, *args, **kwargs):
+        MorphService.__init__(self, *args, **kwargs)
+        self.gate = threading.Event()
+
+    def render(self, key, request):
+        self.gate.wait()
+        return MorphService.render(self, key, request)
+
+
+def post(url, body):
+    """
+    POSTs body as JSON or raw bytes, returns status and decoded JSON answer.
+    """
+    data = body if isinstance(body, bytes) else json.dumps(body).encode()
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url + "/morph", data)) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as error:
+        return error.code, json.loads(error.read())
+
+
+def get(url, path):
+    """
+    GETs path, returns status and body bytes.
+    """
+    try:
+        with urllib.request.urlopen(url + path) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as error:
+        return error.code, error.read()
+
+
+def serve(service):
+    """
+    Starts service on a free localhost port in a daemon thread, returns the
+    server and its url.
+    """
+    server = make_server(service, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://%s:%d" % server.server_address
+
+
+def in_threads(fn, args):
+    """
+    Starts a thread calling fn for each of args. Returns the threads and the
+    list their results are stored in, in order, once they are joined.
+    """
+    results = [None] * len(args)
+
+    def run(i):
+        results[i] = fn(args[i])
+    threads = [threading.Thread(target=run, args=(i, )) for i in range(0, len(args))]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def wait_inflight(service, count):
+    """
+    Waits until count requests are in flight on service.
+    """
+    while True:
+        with service.lock:
+            if len(service.inflight) >= count:
+                return
+        threading.Event().wait(0.01)
+
+
+def verify(directory, width=320, height=240, steps=4):
+    """
+    Checks MorphService over HTTP on localhost for 400 on malformed bodies,
+    coalescing of identical requests in flight, 503 once max_queue requests
+    are pending, retrieval of every reported frame, 413 for requests larger
+    than the frame cache and that cached frames are evicted per request.
+    Returns a list of failure messages.
+    """
+    img1, img2, points1, points2 = synthetic_pair(width, height, 20)
+    paths = [os.path.join(directory, name) for name in ("a.png", "b.png")]
+    cv2.imwrite(paths[0], img1)
+    cv2.imwrite(paths[1], img2)
+    request = {"image1": paths[0], "image2": paths[1], "points1": [list(point) for point in points1],
+               "points2": [list(point) for point in points2], "alpha": 0.5, "steps": steps}
+    failures = []
+
+    service = GatedService(workers=1, max_queue=2)
+    server, url = serve(service)
+    try:
+        malformed = [b"not json", b"[1, 2]", dict(request, points1=5), dict(request, steps="x"),
+                     dict(request, points2=request["points2"][:-1]), dict(request, alpha=2),
+                     dict(request, image1=os.path.join(directory, "missing.png"))]
+        for body in malformed:
+            status = post(url, body)[0]
+            if status != 400:
+                failures.append("malformed body %.60r answered %d instead of 400" % (body, status))
+
+        # Three identical requests share one render, a second distinct one
+        # fills max_queue, a third one is refused.
+        threads, results = in_threads(lambda body: post(url, body), [request] * 3 + [dict(request, alpha=0.25)])
+        wait_inflight(service, 2)
+        while service.coalesced < 2:
+            threading.Event().wait(0.01)
+        status = post(url, dict(request, alpha=0.75))[0]
+        if status != 503:
+            failures.append("request beyond max_queue answered %d instead of 503" % (status, ))
+        service.gate.set()
+        for thread in threads:
+            thread.join()
+        if [status for status, answer in results] != [200] * 4:
+            failures.append("in flight requests answered %s" % ([answer for status, answer in results], ))
+        elif len(set(answer["key"] for status, answer in results[:3])) != 1:
+            failures.append("identical requests got different keys")
+        metrics = json.loads(get(url, "/metrics")[1])
+        if metrics["coalesced"] != 2 or metrics["completed"] != 2:
+            failures.append("expected 2 coalesced and 2 completed renders, metrics %s" % (metrics, ))
+
+        status, answer = post(url, request)
+        if status != 200 or answer["frames"] != steps:
+            failures.append("cached request answered %d %s" % (status, answer))
+        elif json.loads(get(url, "/metrics")[1])["completed"] != 2:
+            failures.append("cached request was rendered again")
+        else:
+            for index in range(0, answer["frames"]):
+                status, png = get(url, "/frame/%s/%d" % (answer["key"], index))
+                frame = cv2.imdecode(np.frombuffer(png, np.uint8), cv2.IMREAD_COLOR) if status == 200 else None
+                if frame is None or frame.ndim != 3:
+                    failures.append("frame %d answered %d" % (index, status))
+            status = get(url, "/frame/%s/%d" % (answer["key"], answer["frames"]))[0]
+            if status != 404:
+                failures.append("frame past the end answered %d instead of 404" % (status, ))
+    finally:
+        service.gate.set()
+        server.shutdown()
+        server.server_close()
+        service.shutdown()
+
+    # A frame cache that holds one request but not two
+    service = MorphService(workers=1, frame_bytes=1)
+    server, url = serve(service)
+    try:
+        status = post(url, request)[0]
+        if status != 413:
+            failures.append("request larger than the frame cache answered %d instead of 413" % (status, ))
+        service.frames.max_bytes = 2 ** 30
+        size = sum(len(png) for png in service.render(None, dict(request, alpha=0.25)))
+        service.frames.max_bytes = size * 3 // 2
+        answers = [post(url, dict(request, alpha=alpha))[1] for alpha in (0.25, 0.75)]
+        for answer, alpha in zip(answers, (0.25, 0.75)):
+            available = [get(url, "/frame/%s/%d" % (answer["key"], index))[0] == 200
+                         for index in range(0, answer["frames"])]
+            if alpha == 0.75 and not all(available):
+                failures.append("frames %s of the last request are missing" % (available, ))
+            if alpha == 0.25 and any(available):
+                failures.append("frames %s of the evicted request are partially kept" % (available, ))
+    finally:
+        server.shutdown()
+        server.server_close()
+        service.shutdown()
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Verify the morph service against localhost.")
+    parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp()
+    try:
+        failures = verify(directory)
+    finally:
+        shutil.rmtree(directory)
+    for failure in failures:
+        print(failure)
+    print("%d failures" % len(failures))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())